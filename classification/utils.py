@@ -1,6 +1,7 @@
 import torch
 import shutil
 import os
+import csv
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -188,38 +189,59 @@ def accuracy(output, target, topk=(1,)):
 
 
 class Confidence_Diagram():
-    def __init__(self,n_classes):
+    """Reliability diagram / ECE accumulator.
+
+    Pixels (or samples) are counted per (confidence bin, target class,
+    correct) with one bincount on the device of the inputs; accumulators
+    of several batches or processes add up with merge/all_reduce.
+    """
+    def __init__(self, n_classes, n_bins=10):
         # self.logdir = logdir
         self.num_class = n_classes
-        self.correct = np.zeros((10,n_classes))
-        self.count = np.zeros((10,n_classes))
-        self.confidence = np.zeros((10,n_classes))
+        self.n_bins = n_bins
+        self.reset()
 
         # self.file_name = file_name
 
+    def reset(self):
+        # [count, confidence sum] x bin x class x [wrong, correct]
+        self.stats = None
+
     def aggregate_stats(self,prob,predicted,targets):
         # prob [batch,w,h]
         # predicted [batch,w,h]
         # targets [batch, w,h]
-        
-        bins = prob // 0.1 #[batch,w,h] confidence
-        bins = bins.masked_fill(bins == 10.,9)
-        # for i in range(targets.shape[1]):
-        #     mask = predicted == targets[:,i,:,:]
-
-        for i in np.linspace(0,9,10):
-            mask_bin = bins == i
-            for j in range(16):
-                mask_class = targets == j
-                self.correct[int(i),int(j)] += (predicted[mask_bin*mask_class] == targets[mask_bin*mask_class]).sum()
-                self.count[int(i),int(j)] += (mask_bin*mask_class).sum()
-                self.confidence[int(i),int(j)] +=  prob[mask_bin*mask_class].sum()
+        prob = prob.reshape(-1)
+        predicted = predicted.reshape(-1).to(prob.device)
+        targets = targets.reshape(-1).to(prob.device).long()
+        if self.stats is None:
+            self.stats = torch.zeros(2 * self.n_bins * self.num_class * 2, dtype=torch.float64, device=prob.device)
+
+        mask = (targets >= 0) & (targets < self.num_class)
+        prob, predicted, targets = prob[mask], predicted[mask], targets[mask]
+        bins = (prob * self.n_bins).long().clamp(0, self.n_bins - 1) #[batch,w,h] confidence
+        keys = (bins * self.num_class + targets) * 2 + (predicted == targets).long()
+        size = self.n_bins * self.num_class * 2
+        self.stats[:size] += torch.bincount(keys, minlength=size).double()
+        self.stats[size:] += torch.bincount(keys, weights=prob.double(), minlength=size)
+
+    def merge(self, other):
+        if other.stats is not None:
+            self.stats = other.stats.clone() if self.stats is None else self.stats + other.stats.to(self.stats.device)
+
+    def all_reduce(self):
+        if self.stats is not None and torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.stats)
 
     def compute_ece(self):  
-        self.accuracy = self.correct/self.count
-        self.confidence = self.confidence/self.count
-        # import ipdb;ipdb.set_trace()
-        ratio = self.count/np.expand_dims(np.nansum(self.count,0),0)
+        stats = np.zeros(2 * self.n_bins * self.num_class * 2) if self.stats is None else self.stats.cpu().numpy()
+        stats = stats.reshape(2, self.n_bins, self.num_class, 2)
+        self.count = stats[0].sum(2)
+        self.correct = stats[0, :, :, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.accuracy = self.correct/self.count
+            self.confidence = stats[1].sum(2)/self.count
+            ratio = self.count/np.expand_dims(np.nansum(self.count,0),0)
         self.ece_cls = np.nansum(ratio*abs(self.accuracy - self.confidence),0)
         self.ece = np.sum(self.ece_cls)/self.num_class
         
@@ -0,0 +1,62 @@
+import os
+import yaml
+import torch
+import argparse
+import numpy as np
+from collections import defaultdict
+from ptsemseg.loader.synthia_loader import synthiaLoader
+from ptsemseg.loader.synthia_prior import class_counts
+
+
+def build(cfg, n_workers):
+    data_cfg = cfg['data']
+    # degradations leave the labels untouched, count each condition once
+    conditions = defaultdict(int)
+    for subsplit in data_cfg['val_subsplit']:
+        conditions[subsplit.split("__")[0]] += 1
+
+    length = np.zeros(len(synthiaLoader.class_names))
+    for condition, n_envs in conditions.items():
+        loader = synthiaLoader(data_cfg['path'],
+                               split=data_cfg['val_split'],
+                               subsplits=[condition],
+                               scale_quantity=data_cfg['val_reduction'],
+                               img_size=(data_cfg['img_rows'], data_cfg['img_cols']),
+                               index_dir=data_cfg.get('index_dir'),
+                               shard_root=data_cfg.get('shard_path'),
+                               uint8=True,
+                               display=False)
+        length += class_counts(loader, n_workers=n_workers) * n_envs
+    return length / length.sum()
+
+
+if __name__ == "__main__":
+    # python build_prior.py --config ./configs/synthia/eval/rgbd_synthia.yml
+    parser = argparse.ArgumentParser(description="config")
+    parser.add_argument(
+        "--config",
+        nargs="?",
+        type=str,
+        default="configs/synthia/eval/rgbd_synthia.yml",
+        help="Configuration file to use",
+    )
+    parser.add_argument(
+        "--n_workers",
+        nargs="?",
+        type=int,
+        default=8,
+        help="Number of label reading processes",
+    )
+
+    args = parser.parse_args()
+    with open(args.config) as fp:
+        cfg = defaultdict(lambda: None, yaml.load(fp))
+
+    logdir = "runs" + '/' + args.config.split("/")[2]
+    save_dir = os.path.join(logdir, 'stats')
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    prior = build(cfg, args.n_workers)
+    torch.save(prior, os.path.join(save_dir, 'prior.pkl'))
+    print(prior)
+    print('saved prior at {}'.format(os.path.join(save_dir, 'prior.pkl')))
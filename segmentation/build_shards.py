@@ -0,0 +1,57 @@
+import os
+import yaml
+import argparse
+from collections import defaultdict
+from ptsemseg.loader.synthia_loader import synthiaLoader
+from ptsemseg.loader.synthia_index import get_index
+from ptsemseg.loader.synthia_shards import shard_dir, write_shard
+
+
+def build(cfg, n_workers):
+    data_cfg = cfg['data']
+    shard_root = data_cfg['shard_path']
+    img_size = (data_cfg['img_rows'], data_cfg['img_cols'])
+    index = get_index(data_cfg['path'],
+                      synthiaLoader.image_modes,
+                      synthiaLoader.cam_pos,
+                      synthiaLoader.sides,
+                      index_dir=data_cfg.get('index_dir'))
+
+    jobs = set()
+    for split_key, subsplit_key in [('train_split', 'train_subsplit'), ('val_split', 'val_subsplit')]:
+        for subsplit in data_cfg[subsplit_key]:
+            # degradations are applied on the fly, the shard holds the clean frames
+            jobs.add((data_cfg[split_key], subsplit.split("__")[0]))
+
+    for split, condition in sorted(jobs):
+        out_dir = shard_dir(shard_root, split, condition, img_size)
+        entries = index.lookup(condition, split)
+        print("Writing {} frames of {} {} to {}".format(len(entries), split, condition, out_dir))
+        write_shard(entries, out_dir, img_size, n_workers=n_workers)
+
+
+if __name__ == "__main__":
+    # python build_shards.py --config ./configs/synthia/eval/rgbd_synthia.yml
+    parser = argparse.ArgumentParser(description="config")
+    parser.add_argument(
+        "--config",
+        nargs="?",
+        type=str,
+        default="configs/synthia/eval/rgbd_synthia.yml",
+        help="Configuration file to use",
+    )
+    parser.add_argument(
+        "--n_workers",
+        nargs="?",
+        type=int,
+        default=8,
+        help="Number of decoding processes",
+    )
+
+    args = parser.parse_args()
+    with open(args.config) as fp:
+        cfg = defaultdict(lambda: None, yaml.load(fp))
+    if not cfg['data'].get('shard_path'):
+        raise ValueError("Set data.shard_path in {}".format(args.config))
+    build(cfg, args.n_workers)
+    print('Done!!!')
@@ -0,0 +1,70 @@
+import os
+import yaml
+import argparse
+from collections import defaultdict
+from ptsemseg.loader.synthia_loader import synthiaLoader
+
+
+def build(cfg, split, n_workers):
+    data_cfg = cfg['data']
+    split_key, subsplit_key = {'train': ('train_split', 'train_subsplit'),
+                               'val': ('val_split', 'val_subsplit')}[split]
+    loader = synthiaLoader(data_cfg['path'],
+                           split=data_cfg[split_key],
+                           subsplits=data_cfg[subsplit_key],
+                           is_transform=True,
+                           img_size=(data_cfg['img_rows'], data_cfg['img_cols']),
+                           index_dir=data_cfg.get('index_dir'),
+                           shard_root=data_cfg.get('shard_path'),
+                           uint8=True,
+                           display=False)
+    return loader.dataset_statistics(n_workers=n_workers)
+
+
+if __name__ == "__main__":
+    # python dataset_stats.py --config ./configs/synthia/eval/rgbd_synthia.yml
+    parser = argparse.ArgumentParser(description="config")
+    parser.add_argument(
+        "--config",
+        nargs="?",
+        type=str,
+        default="configs/synthia/eval/rgbd_synthia.yml",
+        help="Configuration file to use",
+    )
+    parser.add_argument(
+        "--split",
+        nargs="?",
+        type=str,
+        default="train",
+        choices=["train", "val"],
+        help="Measure the train_split/train_subsplit or val_split/val_subsplit frames",
+    )
+    parser.add_argument(
+        "--n_workers",
+        nargs="?",
+        type=int,
+        default=8,
+        help="Number of decoding processes",
+    )
+    parser.add_argument(
+        "--out",
+        nargs="?",
+        type=str,
+        default=None,
+        help="Output yaml, usable as data.norm_stats (default runs/<config>/stats/dataset_stats.yml)",
+    )
+
+    args = parser.parse_args()
+    with open(args.config) as fp:
+        cfg = defaultdict(lambda: None, yaml.load(fp))
+
+    out = args.out
+    if out is None:
+        out = os.path.join("runs", args.config.split("/")[2], "stats", "dataset_stats.yml")
+    if os.path.dirname(out) and not os.path.isdir(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+
+    stats = build(cfg, args.split, args.n_workers)
+    with open(out, "w") as fp:
+        yaml.safe_dump(stats, fp, default_flow_style=None)
+    print('saved dataset statistics at {}'.format(out))
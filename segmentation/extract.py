@@ -9,12 +9,13 @@ import numpy as np
 from torch.utils import data
 from tqdm import tqdm
 from ptsemseg.models import get_model
-from ptsemseg.loader import get_loaders
+from ptsemseg.loader import get_loaders, deviceTransform
 from ptsemseg.degredations import *
+from ptsemseg.metrics import runningMoments
 from collections import defaultdict
 
 
-def validate(cfg, logdir):
+def validate(cfg, logdir, shard=0, n_shards=1, per_condition=False, per_class=False):
     # log git commit
     import subprocess
     label = subprocess.check_output(["git", "describe", "--always"]).strip()
@@ -36,6 +37,8 @@ def validate(cfg, logdir):
                                   mcdo_passes=attr['mcdo_passes'],
                                   dropoutP=attr['dropoutP'],
                                   full_mcdo=attr['full_mcdo'],
+                                  mc_micro_batch=attr['mc_micro_batch'],
+                                  mc_streaming=bool(attr['mc_streaming']),
                                   backbone=attr['backbone'],
                                   device=device).to(device)
 
@@ -59,43 +62,111 @@ def validate(cfg, logdir):
     #################################################################################
     print("=" * 10, "Extracting", "=" * 10)
     [models[m].eval() for m in models.keys()]
+    accumulators = new_accumulators(cfg["models"].keys(), loaders['val'].keys(), n_classes)
     with torch.no_grad():
-        length = {} 
-        entropy_overall = {}                
-        for m in cfg["models"].keys():
-            length[m] = np.zeros(n_classes)
-            entropy_overall[m] = []
         for k, valloader in loaders['val'].items():
+            valloader = shard_loader(valloader, shard, n_shards)
+            if cfg['data'].get('uint8'):
+                transform = deviceTransform.from_loader(valloader.dataset, device)
             for i_val, (input_list, labels_list) in tqdm(enumerate(valloader)):
+                if cfg['data'].get('uint8'):
+                    input_list, labels_list = transform(input_list, labels_list, display=False)
                 images_val = {m: input_list[m][0] for m in cfg["models"].keys()}
                 labels_val = labels_list[0]
-                if labels_val.shape[0] <= 1:
-                    continue
                 # Inference
                 for m in cfg["models"].keys():
-                    _, entropy = models[m](images_val[m])
-                    entropy_overall[m].extend(entropy.mean((1,2)).cpu().numpy().tolist())      
-                    for i in range(n_classes):
-                        mask = labels_val != i
-                        length_temp = (labels_val == i).sum()
-                        if length_temp != 0:
-                            length[m][i] += length_temp
-
-                   
-
-        save_dir = os.path.join(logdir,'stats')
-        if not os.path.isdir(save_dir):
-            os.makedirs(save_dir)
-        prior = length[m]/length[m].sum()
-        torch.save(prior, os.path.join(logdir,'stats','prior.pkl'))
-        print(prior)
-        print('saved prior at {}'.format(os.path.join(logdir,'stats','prior.pkl')))
-        entropy_stats = {}
-        for m in cfg["models"].keys():
-            entropy_stats[m+'_mean'] = np.mean(entropy_overall[m])
-            entropy_stats[m+'_std'] = np.std(entropy_overall[m])
-        torch.save(entropy_stats,os.path.join(logdir,'stats','entropy.pkl'))
-        print('saved entropy at {}'.format(os.path.join(logdir,'stats','entropy.pkl')))
+                    _, entropy = models[m](images_val[m], output='entropy')
+                    image_entropy = entropy.mean((1,2)).double().cpu().numpy()[None]
+                    accumulators['overall'][m].update(image_entropy)
+                    if per_condition:
+                        accumulators['condition'][m][k].update(image_entropy)
+                    if per_class:
+                        accumulators['class'][m].merge(*class_moments(entropy, labels_val.to(entropy.device), n_classes))
+
+    save_dir = os.path.join(logdir,'stats')
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    # the label prior does not need the models, see build_prior.py
+    if n_shards > 1:
+        path = shard_path(logdir, shard, n_shards)
+        torch.save(state_dict(accumulators), path)
+        print('saved entropy shard at {}, merge with --merge --n_shards {}'.format(path, n_shards))
+    else:
+        save_entropy(accumulators, logdir, per_condition, per_class)
+
+
+def new_accumulators(modalities, envs, n_classes):
+    return {'overall': {m: runningMoments(1) for m in modalities},
+            'condition': {m: {env: runningMoments(1) for env in envs} for m in modalities},
+            'class': {m: runningMoments(n_classes) for m in modalities}}
+
+
+def shard_loader(valloader, shard, n_shards):
+    """Loader over the contiguous block ``shard`` of ``n_shards`` of the dataset."""
+    if n_shards == 1:
+        return valloader
+    indices = np.array_split(np.arange(len(valloader.dataset)), n_shards)[shard]
+    # the samples still carry their dataset index, see synthiaLoader.degrade_batch
+    return data.DataLoader(data.Subset(valloader.dataset, indices.tolist()),
+                           batch_size=valloader.batch_size,
+                           num_workers=valloader.num_workers,
+                           pin_memory=valloader.pin_memory)
+
+
+def class_moments(entropy, labels, n_classes):
+    """(count, mean, m2) of the pixel entropies of each ground truth class"""
+    labels = labels.reshape(-1)
+    entropy = entropy.reshape(-1).double()
+    count = torch.bincount(labels, minlength=n_classes)[:n_classes]
+    total = torch.bincount(labels, weights=entropy, minlength=n_classes)[:n_classes]
+    total_sq = torch.bincount(labels, weights=entropy * entropy, minlength=n_classes)[:n_classes]
+    return runningMoments.sums_to_moments(count.cpu().numpy(), total.cpu().numpy(), total_sq.cpu().numpy())
+
+
+def state_dict(accumulators):
+    if isinstance(accumulators, runningMoments):
+        return accumulators.state_dict()
+    return {key: state_dict(value) for key, value in accumulators.items()}
+
+
+def merge_state(accumulators, state):
+    for key, value in state.items():
+        if key not in accumulators:
+            accumulators[key] = runningMoments.from_state_dict(value) if 'm2' in value else merge_state({}, value)
+        elif isinstance(accumulators[key], runningMoments):
+            accumulators[key].merge(value['count'], value['mean'], value['m2'])
+        else:
+            merge_state(accumulators[key], value)
+    return accumulators
+
+
+def shard_path(logdir, shard, n_shards):
+    return os.path.join(logdir, 'stats', 'entropy_shard{:03d}of{:03d}.pkl'.format(shard, n_shards))
+
+
+def merge_shards(logdir, n_shards, per_condition, per_class):
+    accumulators = {}
+    for shard in range(n_shards):
+        path = shard_path(logdir, shard, n_shards)
+        if not os.path.isfile(path):
+            raise IOError("Missing entropy shard {}".format(path))
+        merge_state(accumulators, torch.load(path))
+    save_entropy(accumulators, logdir, per_condition, per_class)
+
+
+def save_entropy(accumulators, logdir, per_condition, per_class):
+    entropy_stats = {}
+    for m, moments in accumulators['overall'].items():
+        entropy_stats[m+'_mean'] = float(moments.mean[0])
+        entropy_stats[m+'_std'] = float(moments.std[0])
+        if per_condition:
+            entropy_stats[m+'_condition'] = {env: {'mean': float(c.mean[0]), 'std': float(c.std[0])}
+                                             for env, c in accumulators['condition'][m].items()}
+        if per_class:
+            c = accumulators['class'][m]
+            entropy_stats[m+'_class'] = {'mean': c.mean, 'std': c.std, 'count': c.count}
+    torch.save(entropy_stats,os.path.join(logdir,'stats','entropy.pkl'))
+    print('saved entropy at {}'.format(os.path.join(logdir,'stats','entropy.pkl')))
 
 
 if __name__ == "__main__":
@@ -108,6 +179,35 @@ if __name__ == "__main__":
         default="configs/train/rgbd_BayesianSegnet_0.5_T000.yml",
         help="Configuration file to use",
     )
+    parser.add_argument(
+        "--shard",
+        nargs="?",
+        type=int,
+        default=0,
+        help="Index of the block of frames handled by this process",
+    )
+    parser.add_argument(
+        "--n_shards",
+        nargs="?",
+        type=int,
+        default=1,
+        help="Number of processes the frames are split over",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the n_shards partial results into stats/entropy.pkl",
+    )
+    parser.add_argument(
+        "--per_condition",
+        action="store_true",
+        help="Also store entropy statistics per val subsplit",
+    )
+    parser.add_argument(
+        "--per_class",
+        action="store_true",
+        help="Also store pixel entropy statistics per ground truth class",
+    )
 
     args = parser.parse_args()
     with open(args.config) as fp:
@@ -116,6 +216,9 @@ if __name__ == "__main__":
     logdir = "runs" +'/'+ args.config.split("/")[2]
     if not os.path.exists(  logdir):
         os.makedirs(logdir)
-    path = shutil.copy(args.config, logdir)
-    validate(cfg,logdir)
+    if args.merge:
+        merge_shards(logdir, args.n_shards, args.per_condition, args.per_class)
+    else:
+        path = shutil.copy(args.config, logdir)
+        validate(cfg, logdir, args.shard, args.n_shards, args.per_condition, args.per_class)
     print('Done!!!')
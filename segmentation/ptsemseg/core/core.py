@@ -3,38 +3,48 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
        
+def entropy_scale(entropy, entropy_stats, modality):
+    """DR of likelihood_flattening, (batch,1,1,1).
+
+    :param entropy_stats: extract.py statistics, keyed '<modality>_mean' and
+        '<modality>_std' for every modality of the configuration
+    """
+    SoftEn_MEAN = entropy_stats[modality + '_mean']
+    SoftEn_STD = entropy_stats[modality + '_std']
+    STD_MEAN = (entropy.mean((1, 2)) - SoftEn_MEAN - SoftEn_STD).clamp(min=0) + SoftEn_MEAN
+    return (SoftEn_MEAN / STD_MEAN).view(-1, 1, 1, 1)
+
+
 def likelihood_flattening(mean, cfg, entropy, entropy_stats, modality):
     if not cfg['uncertainty']:
         return mean
     else:
-        if modality == 'rgb': 
-            SoftEn_MEAN = entropy_stats['rgb_mean']
-            SoftEn_STD =  entropy_stats['rgb_std']
-        else:
-            SoftEn_MEAN = entropy_stats['d_mean']
-            SoftEn_STD = entropy_stats['d_std']
-        STD_MEAN = torch.max(torch.zeros_like(entropy.mean((1,2))),entropy.mean((1,2)) - SoftEn_MEAN - SoftEn_STD)+SoftEn_MEAN
-        DR = SoftEn_MEAN/STD_MEAN.unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
-        return mean*DR
-        
+        return mean * entropy_scale(entropy, entropy_stats, modality)
+
+
+def stack_modalities(mean, cfg):
+    """dict modality -> [batch,n_classes,H,W] to [n_modalities,batch,n_classes,H,W], in cfg['models'] order"""
+    return torch.stack([mean[m] for m in cfg['models'].keys()])
 
 
 def fusion(mean,cfg,**kargs):
-    if len(cfg['models'].keys()) == 1:
-        return mean[list(cfg["models"].keys())[0]]
+    """
+    :param mean: per-modality probabilities stacked [n_modalities,batch,n_classes,H,W]
+        (see stack_modalities), or a dict modality -> [batch,n_classes,H,W]
+    :return: fused probabilities [batch,n_classes,H,W], normalised over dim 1
+    """
+    if isinstance(mean, dict):
+        mean = stack_modalities(mean, cfg)
+    if mean.shape[0] == 1:
+        return mean[0]
     elif cfg["fusion"] == "SoftmaxMultiply":
-        outputs = mean["rgb"] * mean["d"]
-        if 'rgbd' in mean:
-            outputs = outputs * mean["rgbd"]
+        outputs = mean.prod(0)
     elif cfg["fusion"] == "SoftmaxAverage":
-        outputs = mean["rgb"] + mean["d"]
-        if 'rgbd' in mean:
-            outputs = outputs + mean["rgbd"]
+        outputs = mean.sum(0)
     elif cfg["fusion"] == "Noisy-Or":
-        if 'rgbd' in mean:
-            outputs = 1 - (1 - mean["rgb"]) * (1 - mean["d"]) * (1 - mean["rgbd"]) #[batch,11,512,512]
-        else:
-            outputs = 1 - (1 - mean["rgb"]) * (1 - mean["d"]) #[batch,11,512,512]
+        outputs = 1 - (1 - mean).prod(0) #[batch,11,512,512]
+    else:
+        raise ValueError("Unknown fusion {}".format(cfg["fusion"]))
     outputs = outputs/outputs.sum(1).unsqueeze(1)
     return outputs 
 
@@ -53,4 +63,89 @@ def prior_recbalancing(mean,cfg,**kargs):
         mean_temp = mean_temp/mean_temp.sum(1).unsqueeze(1)
         mean_temp = mean[m]**(1-cfg["imbalance"]['beta']) * mean_temp**cfg["imbalance"]['beta'] 
         outputs[m] = mean_temp/mean_temp.sum(1).unsqueeze(1)
-    return outputs
\ No newline at end of file
+    return outputs
+
+
+class unoFusion(object):
+    """likelihood_flattening, prior_recbalancing and fusion as one operator.
+
+    With z the (uncertainty scaled) logits, the prior recalibrated posterior
+    p**(1-beta) * (p/prior)**beta, renormalised, is softmax(z + beta*log(1/prior)),
+    so each modality costs one log_softmax and the prior term is computed
+    once. Modalities are accumulated in log space into a single buffer:
+    log q for SoftmaxMultiply, q for SoftmaxAverage and log(1-q) for Noisy-Or.
+    Inference only, intermediate tensors are reused in place.
+
+    :param prior: class prior shaped (1, n_classes, 1, 1), only used when
+        cfg['imbalance']['beta'] is set
+    """
+
+    def __init__(self, cfg, prior=None, entropy_stats=None):
+        self.modalities = list(cfg['models'].keys())
+        self.uncertainty = cfg['uncertainty']
+        self.entropy_stats = entropy_stats
+        self.fusion = cfg['fusion']
+        if len(self.modalities) > 1 and self.fusion not in ['SoftmaxMultiply', 'SoftmaxAverage', 'Noisy-Or']:
+            raise ValueError("Unknown fusion {}".format(self.fusion))
+
+        beta = cfg['imbalance']['beta'] if cfg['imbalance'] else None
+        if beta:
+            inv_prior = 1 / prior
+            inv_prior[inv_prior == float("inf")] = 0
+            # -inf for classes without prior, which get probability 0
+            self.prior_shift = beta * inv_prior.log()
+        else:
+            # beta None or 0 leaves the softmax unchanged
+            self.prior_shift = None
+
+    def scale(self, entropy, modality):
+        # DR of likelihood_flattening, (batch,1,1,1) or None
+        if not self.uncertainty:
+            return None
+        return entropy_scale(entropy, self.entropy_stats, modality)
+
+    def log_calibrated(self, logits, entropy, modality):
+        """log of the flattened, prior recalibrated softmax of one modality."""
+        DR = self.scale(entropy, modality)
+        z = logits if DR is None else logits * DR
+        if self.prior_shift is not None:
+            z = z + self.prior_shift if z is logits else z.add_(self.prior_shift)
+        return F.log_softmax(z, dim=1)
+
+    @torch.no_grad()
+    def calibrated(self, logits, entropy, modality):
+        """Probabilities of one modality, mean[m] after prior_recbalancing."""
+        return self.log_calibrated(logits, entropy, modality).exp_()
+
+    @torch.no_grad()
+    def __call__(self, logits, entropy=None, out=None):
+        """
+        :param logits: dict modality -> logits [batch,n_classes,H,W], or the
+            logits stacked [n_modalities,batch,n_classes,H,W] in cfg['models'] order
+        :param entropy: entropies [batch,H,W] keyed or stacked like logits,
+            needed with cfg['uncertainty']
+        :param out: optional buffer for the fused probabilities
+        :return: fused probabilities, normalised over dim 1
+        """
+        acc = None
+        stacked = torch.is_tensor(logits)
+        for i, m in enumerate(self.modalities):
+            key = i if stacked else m
+            term = self.log_calibrated(logits[key], None if entropy is None else entropy[key], m)
+            if len(self.modalities) == 1 or self.fusion == 'SoftmaxAverage':
+                term.exp_()
+            elif self.fusion == 'Noisy-Or':
+                term = term.exp_().neg_().log1p_()  # log(1-q)
+            if acc is None:
+                acc = term if out is None else out.copy_(term)
+            else:
+                acc.add_(term)
+
+        if len(self.modalities) == 1:
+            return acc
+        if self.fusion == 'SoftmaxMultiply':
+            acc.sub_(torch.logsumexp(acc, 1, keepdim=True)).exp_()
+        elif self.fusion == 'Noisy-Or':
+            # 1 - prod(1-q)
+            acc.expm1_().neg_()
+        return acc.div_(acc.sum(1, keepdim=True))
@@ -0,0 +1,189 @@
+import os
+import time
+import queue
+import threading
+import torch
+from ptsemseg.metrics import averageMeter
+
+
+def _tensors(x):
+    if torch.is_tensor(x):
+        yield x
+    elif isinstance(x, (tuple, list)):
+        for item in x:
+            for t in _tensors(item):
+                yield t
+    elif isinstance(x, dict):
+        for item in x.values():
+            for t in _tensors(item):
+                yield t
+
+
+class _modalityWorker(threading.Thread):
+    """Thread running one modality's tasks with its own intra-op thread count."""
+
+    def __init__(self, n_threads, cores=None):
+        super(_modalityWorker, self).__init__()
+        self.daemon = True
+        self.n_threads = n_threads
+        self.cores = cores
+        self.tasks = queue.Queue()
+
+    def run(self):
+        if self.cores and hasattr(os, 'sched_setaffinity'):
+            # pid 0 is the calling thread, the OpenMP threads it starts inherit the set
+            os.sched_setaffinity(0, self.cores)
+        torch.set_num_threads(self.n_threads)
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            fn, grad_enabled, done = task
+            try:
+                # grad mode is thread local
+                with torch.set_grad_enabled(grad_enabled):
+                    start = time.time()
+                    result = fn()
+                    done.put((result, time.time() - start, None))
+            except BaseException as e:
+                done.put((None, 0., e))
+
+    def submit(self, fn):
+        done = queue.Queue(maxsize=1)
+        self.tasks.put((fn, torch.is_grad_enabled(), done))
+        return done
+
+
+class modalityExecutor(object):
+    """Runs the independent per-modality experts of a batch concurrently.
+
+    On CUDA every modality is issued on its own stream, which waits for the
+    current stream first; the current stream waits for all of them before
+    the results are returned, so fusion can use them directly. On CPU every
+    modality runs in its own thread with torch.get_num_threads() split
+    between them and, with pin, on its own set of cores.
+
+    Per-modality latency is kept in averageMeters (seconds, measured with
+    CUDA events on the GPU) together with the wall time of the whole call.
+
+    :param modalities: modality names, in the order of cfg['models']
+    :param concurrent: False runs the modalities one after another
+    """
+
+    def __init__(self, modalities, device, concurrent=True, pin=False):
+        self.modalities = list(modalities)
+        self.device = torch.device(device)
+        self.concurrent = concurrent and len(self.modalities) > 1
+        self.meters = {m: averageMeter() for m in self.modalities + ['all']}
+        self.pending = []
+        self.streams = None
+        self.workers = None
+        if not self.concurrent:
+            return
+        if self.device.type == 'cuda':
+            self.streams = {m: torch.cuda.Stream(self.device) for m in self.modalities}
+        else:
+            n = len(self.modalities)
+            n_threads = max(1, torch.get_num_threads() // n)
+            cores = None
+            if pin and hasattr(os, 'sched_getaffinity'):
+                available = sorted(os.sched_getaffinity(0))
+                per_modality = max(1, len(available) // n)
+                cores = [available[i * per_modality:(i + 1) * per_modality] or available for i in range(n)]
+            self.workers = {}
+            for i, m in enumerate(self.modalities):
+                self.workers[m] = _modalityWorker(n_threads, None if cores is None else cores[i])
+                self.workers[m].start()
+
+    def __call__(self, fn):
+        """
+        :param fn: fn(modality) running one modality's expert
+        :return: dict modality -> fn(modality)
+        """
+        self.flush()
+        start = time.time()
+        if self.device.type == 'cuda':
+            begin = torch.cuda.Event(enable_timing=True)
+            begin.record(torch.cuda.current_stream(self.device))
+        if self.streams is not None:
+            results = self._run_streams(fn)
+        elif self.workers is not None:
+            results = self._run_threads(fn)
+        else:
+            results = {}
+            for m in self.modalities:
+                if self.device.type == 'cuda':
+                    results[m] = self._timed_cuda(fn, m, torch.cuda.current_stream(self.device))
+                else:
+                    m_start = time.time()
+                    results[m] = fn(m)
+                    self.meters[m].update(time.time() - m_start)
+        if self.device.type == 'cuda':
+            end = torch.cuda.Event(enable_timing=True)
+            end.record(torch.cuda.current_stream(self.device))
+            self.pending.append(('all', begin, end))
+        else:
+            self.meters['all'].update(time.time() - start)
+        return results
+
+    def _timed_cuda(self, fn, m, stream):
+        begin = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        begin.record(stream)
+        result = fn(m)
+        end.record(stream)
+        self.pending.append((m, begin, end))
+        return result
+
+    def _run_streams(self, fn):
+        current = torch.cuda.current_stream(self.device)
+        results = {}
+        for m in self.modalities:
+            stream = self.streams[m]
+            # inputs were produced on the current stream
+            stream.wait_stream(current)
+            with torch.cuda.stream(stream):
+                results[m] = self._timed_cuda(fn, m, stream)
+        # join before fusion
+        for m in self.modalities:
+            current.wait_stream(self.streams[m])
+            for t in _tensors(results[m]):
+                if t.is_cuda:
+                    # allocated on the side stream, used and freed on the current one
+                    t.record_stream(current)
+        return results
+
+    def _run_threads(self, fn):
+        done = {m: self.workers[m].submit(lambda m=m: fn(m)) for m in self.modalities}
+        results = {}
+        error = None
+        for m in self.modalities:
+            result, elapsed, e = done[m].get()
+            if e is not None:
+                error = error or e
+                continue
+            results[m] = result
+            self.meters[m].update(elapsed)
+        if error is not None:
+            raise error
+        return results
+
+    def flush(self):
+        """Move finished CUDA event timings into the meters."""
+        for m, begin, end in self.pending:
+            end.synchronize()
+            self.meters[m].update(begin.elapsed_time(end) / 1000.)
+        self.pending = []
+
+    def latency(self):
+        """Average latency per modality and of the whole call, in milliseconds."""
+        self.flush()
+        return {m: 1000. * meter.avg for m, meter in self.meters.items() if meter.count}
+
+    def close(self):
+        if self.workers is not None:
+            for worker in self.workers.values():
+                worker.tasks.put(None)
+            for worker in self.workers.values():
+                worker.join()
+            self.workers = None
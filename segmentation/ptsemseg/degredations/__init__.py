@@ -29,3 +29,16 @@ key2deg['saturate'] = saturate
 key2deg['blackoutNoise'] = blackoutNoise
 key2deg['additiveGaussianNoise'] = additiveGaussianNoise
 key2deg['occlusion'] = occlusion
+
+# corruptions with pixel sized parameters, which take a resolution ``scale``
+spatial_deg = {'gaussianBlur', 'glassBlur', 'defocusBlur', 'motionBlur',
+               'snow', 'frost', 'spatter', 'elastic'}
+
+# corruptions whose shared assets depend on the frame shape, see prepare_assets
+shaped_assets = {'fog'}
+
+# corruptions whose value is a noise magnitude rather than a severity level 1..5
+magnitude_deg = {'blackoutNoise', 'additiveGaussianNoise', 'occlusion'}
+
+from ptsemseg.degredations.torch_degredations import key2deg_torch
+from ptsemseg.degredations.plan import degradationPlan
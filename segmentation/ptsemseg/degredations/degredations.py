@@ -8,10 +8,9 @@ from PIL import Image
 import skimage as sk
 from skimage.filters import gaussian
 from io import BytesIO
-from wand.image import Image as WandImage
-from wand.api import library as wandlibrary
-import wand.color as WandColor
-import ctypes
+from functools import lru_cache
+import math
+import inspect
 from PIL import Image as PILImage
 import cv2
 from scipy.ndimage import zoom as scizoom
@@ -22,6 +21,12 @@ from pkg_resources import resource_filename
 
 warnings.simplefilter("ignore", UserWarning)
 
+# skimage 0.19 replaced gaussian's multichannel with channel_axis
+if 'channel_axis' in inspect.signature(gaussian).parameters:
+    rgb_axis = {'channel_axis': -1}
+else:
+    rgb_axis = {'multichannel': True}
+
 
 def disk(radius, alias_blur=0.1, dtype=np.float32):
     if radius <= 8:
@@ -38,25 +43,46 @@ def disk(radius, alias_blur=0.1, dtype=np.float32):
     return cv2.GaussianBlur(aliased_disk, ksize=ksize, sigmaX=alias_blur)
 
 
-# Tell Python about the C method
-wandlibrary.MagickMotionBlurImage.argtypes = (ctypes.c_void_p,  # wand
-                                              ctypes.c_double,  # radius
-                                              ctypes.c_double,  # sigma
-                                              ctypes.c_double)  # angle
+@lru_cache(maxsize=256)
+def _motion_blur_kernel(width, sigma, offsets):
+    # one-sided gaussian weights along the blur direction, as in ImageMagick
+    weights = np.exp(-np.arange(width) ** 2 / (2.0 * sigma ** 2)) / (np.sqrt(2 * np.pi) * sigma)
+    weights /= weights.sum()
+    kernel = np.zeros((2 * width - 1, 2 * width - 1), dtype=np.float32)
+    for weight, (dy, dx) in zip(weights, offsets):
+        kernel[width - 1 + dy, width - 1 + dx] += weight
+    return kernel
+
+
+def motion_blur_kernel(radius, sigma, angle):
+    """Correlation kernel of ImageMagick's MagickMotionBlurImage.
+
+    Pixel (y, x) averages the pixels at (y + dy_i, x + dx_i), i < width,
+    along the blur direction with one-sided gaussian weights. Kernels are
+    cached per (width, sigma, integer offsets), so a random angle only costs
+    the offset computation.
+    """
+    width = 2 * int(math.ceil(radius)) + 1
+    point = (width * np.sin(np.deg2rad(angle)), width * np.cos(np.deg2rad(angle)))
+    hypot = math.hypot(point[0], point[1])
+    offsets = tuple((int(math.ceil(i * point[0] / hypot - 0.5)), int(math.ceil(i * point[1] / hypot - 0.5)))
+                    for i in range(width))
+    return _motion_blur_kernel(width, float(sigma), offsets)
 
 
-# Extend wand.image.Image class to include method signature
-class MotionImage(WandImage):
-    def motion_blur(self, radius=0.0, sigma=0.0, angle=0.0):
-        wandlibrary.MagickMotionBlurImage(self.wand, radius, sigma, angle)
+def _motion_blur(x, radius, sigma, angle):
+    kernel = motion_blur_kernel(radius, sigma, angle)
+    # edge pixels are replicated like ImageMagick's default virtual pixels
+    return cv2.filter2D(np.asarray(x, dtype=np.float32), -1, kernel, borderType=cv2.BORDER_REPLICATE)
 
 
 # modification of https://github.com/FLHerne/mapgen/blob/master/diamondsquare.py
-def plasma_fractal(mapsize=512, wibbledecay=3):
+def plasma_fractal(mapsize=512, wibbledecay=3, rng=np.random):
     """
     Generate a heightmap using diamond-square algorithm.
     Return square 2d array, side length 'mapsize', of floats in range 0-255.
     'mapsize' must be a power of two.
+    'rng' is np.random or a np.random.RandomState.
     """
     assert (mapsize & (mapsize - 1) == 0)
     maparray = np.empty((mapsize, mapsize), dtype=np.float_)
@@ -65,7 +91,7 @@ def plasma_fractal(mapsize=512, wibbledecay=3):
     wibble = 100
 
     def wibbledmean(array):
-        return array / 4 + wibble * np.random.uniform(-wibble, wibble, array.shape)
+        return array / 4 + wibble * rng.uniform(-wibble, wibble, array.shape)
 
     def fillsquares():
         """For each square of points stepsize apart,
@@ -101,17 +127,111 @@ def plasma_fractal(mapsize=512, wibbledecay=3):
     return maparray / maparray.max()
 
 
+class fractalPool(object):
+    """Process-wide pool of pre-generated plasma fractals.
+
+    fog draws one of ``size`` maps per (mapsize, wibbledecay) instead of
+    running the diamond-square algorithm on every frame. A pool is generated
+    on first use from a RandomState seeded with its key, so all workers
+    hold the same maps (stored as float32 to halve their footprint); the map is picked with the global NumPy RNG, which
+    the loader seeds per frame.
+    """
+
+    def __init__(self, size=16, seed=0):
+        self.size = size
+        self.seed = seed
+        self.pools = {}
+
+    def configure(self, size=None, seed=None):
+        if size is not None and size != self.size:
+            self.size = int(size)
+            self.pools = {}
+        if seed is not None and seed != self.seed:
+            self.seed = int(seed)
+            self.pools = {}
+
+    def get(self, mapsize, wibbledecay):
+        key = (mapsize, wibbledecay)
+        if key not in self.pools:
+            rng = np.random.RandomState([self.seed, mapsize, int(round(wibbledecay * 1000))])
+            self.pools[key] = [plasma_fractal(mapsize, wibbledecay, rng=rng).astype(np.float32)
+                               for _ in range(self.size)]
+        return self.pools[key]
+
+    def sample(self, mapsize, wibbledecay):
+        pool = self.get(mapsize, wibbledecay)
+        return pool[np.random.randint(len(pool))]
+
+
+fractal_pool = fractalPool()
+
+# frost draws from the first five textures, like the original randint(5);
+# frost6.jpg ships with the package but was never sampled
+frost_files = ['frost/frost1.png', 'frost/frost2.png', 'frost/frost3.png',
+               'frost/frost4.jpg', 'frost/frost5.jpg']
+
+
+@lru_cache(maxsize=None)
+def frost_textures():
+    """Frost textures as RGB arrays, read from disk once per process.
+
+    Textures missing from the package are skipped.
+    """
+    textures = []
+    for name in frost_files:
+        filename = resource_filename(__name__, name)
+        if os.path.exists(filename):
+            textures.append(cv2.imread(filename)[..., [2, 1, 0]])
+    if not textures:
+        raise IOError("No frost textures found in {}".format(resource_filename(__name__, 'frost')))
+    return tuple(textures)
+
+
+@lru_cache(maxsize=64)
+def frost_texture(idx, scale):
+    """Frost texture ``idx`` resized by ``scale`` (rounded by the caller to keep the cache small)."""
+    frost = frost_textures()[idx]
+    if scale == 1:
+        return frost
+    return cv2.resize(frost, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+
+
+def fractal_size(shape):
+    """Smallest power of two plasma fractal covering an (h, w) frame."""
+    return max(2 ** int(math.ceil(math.log(max(shape[:2]), 2))), 2)
+
+
+def prepare_assets(type, severity, shape=None):
+    """Load the shared assets of a corruption ahead of the first frame, so
+    that forked loader workers inherit them. fog pools need the (h, w) of
+    the frames."""
+    if type == 'fog' and shape is not None:
+        fractal_pool.get(fractal_size(shape), fog_params[severity - 1][1])
+    elif type == 'frost':
+        frost_textures()
+
+
+def asset_version(type):
+    """Identifies the shared assets a corruption draws from, e.g. for cache keys."""
+    if type == 'fog':
+        return "fractals:{}:{}:float32".format(fractal_pool.size, fractal_pool.seed)
+    return ""
+
+
 def clipped_zoom(img, zoom_factor):
-    h = img.shape[0]
-    # ceil crop height(= crop width)
+    h, w = img.shape[:2]
+    # ceil crop height and width
     ch = int(np.ceil(h / float(zoom_factor)))
+    cw = int(np.ceil(w / float(zoom_factor)))
 
     top = (h - ch) // 2
-    img = scizoom(img[top:top + ch, top:top + ch], (zoom_factor, zoom_factor, 1), order=1)
+    left = (w - cw) // 2
+    img = scizoom(img[top:top + ch, left:left + cw], (zoom_factor, zoom_factor, 1), order=1)
     # trim off any extra pixels
     trim_top = (img.shape[0] - h) // 2
+    trim_left = (img.shape[1] - w) // 2
 
-    return img[trim_top:trim_top + h, trim_top:trim_top + h]
+    return img[trim_top:trim_top + h, trim_left:trim_left + w]
 
 
 # /////////////// End Corruption Helpers ///////////////
@@ -119,6 +239,10 @@ def clipped_zoom(img, zoom_factor):
 
 # /////////////// Corruptions ///////////////
 
+# Spatial parameters are in pixels of the frames the corruptions were tuned
+# on; ``scale`` (target over source resolution) rescales them when frames
+# are degraded after resizing, see degradationPlan.
+
 def gaussian_noise(x, severity=1):
     c = [.08, .12, 0.18, 0.26, 0.38][severity - 1]
 
@@ -147,33 +271,58 @@ def speckle_noise(x, severity=1):
     return np.clip(x + x * np.random.normal(size=x.shape, scale=c), 0, 1) * 255
 
 
-def gaussian_blur(x, severity=1):
+def gaussian_blur(x, severity=1, scale=1.):
     c = [1, 2, 3, 4, 6][severity - 1]
 
-    x = gaussian(np.array(x) / 255., sigma=c, multichannel=True)
+    x = gaussian(np.array(x) / 255., sigma=c * scale, **rgb_axis)
     return np.clip(x, 0, 1) * 255
 
 
-def glass_blur(x, severity=1):
+def glass_blur(x, severity=1, scale=1.):
     # sigma, max_delta, iterations
     c = [(0.7, 1, 2), (0.9, 2, 1), (1, 2, 3), (1.1, 3, 2), (1.5, 4, 2)][severity - 1]
+    if scale != 1:
+        c = (c[0] * scale, max(1, int(round(c[1] * scale))), c[2])
 
-    x = np.uint8(gaussian(np.array(x) / 255., sigma=c[0], multichannel=True) * 255)
+    x = np.uint8(gaussian(np.array(x) / 255., sigma=c[0], **rgb_axis) * 255)
+    h, w = x.shape[:2]
 
     # locally shuffle pixels
+    # The reference loop visits (h, w) in descending raster order and does
+    # x[h, w], x[h', w'] = x[h', w'], x[h, w] on numpy views, which amounts to
+    # x[h, w] = x[h', w']. A pixel therefore receives the final value of its
+    # source if that source was visited before it (larger raster index),
+    # else the source's current value. Those copy chains are resolved by
+    # following the sources in bulk, and the displacements are drawn in one
+    # call in visiting order, so the result equals the loop for a given seed.
+    rows = np.arange(h - c[1], c[1], -1)
+    cols = np.arange(w - c[1], c[1], -1)
+    pixels = (rows[:, None] * w + cols[None, :]).ravel()
     for i in range(c[2]):
-        for h in range(512 - c[1], c[1], -1):
-            for w in range(512 - c[1], c[1], -1):
-                dx, dy = np.random.randint(-c[1], c[1], size=(2,))
-                h_prime, w_prime = h + dy, w + dx
-                # swap
-                x[h, w], x[h_prime, w_prime] = x[h_prime, w_prime], x[h, w]
-
-    return np.clip(gaussian(x / 255., sigma=c[0], multichannel=True), 0, 1) * 255
-
-
-def defocus_blur(x, severity=1):
+        dx, dy = np.random.randint(-c[1], c[1], size=(len(rows), len(cols), 2)).reshape(-1, 2).T
+        source = np.arange(h * w)
+        source[pixels] = pixels + dy * w + dx
+        visited = np.zeros(h * w, dtype=bool)
+        visited[pixels] = True
+        # chained: the source is a shuffled pixel that was visited earlier
+        chained = visited
+        chained[pixels] = visited[source[pixels]] & (source[pixels] > pixels)
+        src = source[pixels]
+        active = chained[pixels]
+        while active.any():
+            nxt = src[active]
+            src[active] = source[nxt]
+            active[active] = chained[nxt]
+        flat = x.reshape(h * w, -1)
+        flat[pixels] = flat[src]
+
+    return np.clip(gaussian(x / 255., sigma=c[0], **rgb_axis), 0, 1) * 255
+
+
+def defocus_blur(x, severity=1, scale=1.):
     c = [(3, 0.1), (4, 0.5), (6, 0.5), (8, 0.5), (10, 0.5)][severity - 1]
+    if scale != 1:
+        c = (max(1, int(round(c[0] * scale))), c[1] * scale)
 
     x = np.array(x) / 255.
     kernel = disk(radius=c[0], alias_blur=c[1])
@@ -181,25 +330,18 @@ def defocus_blur(x, severity=1):
     channels = []
     for d in range(3):
         channels.append(cv2.filter2D(x[:, :, d], -1, kernel))
-    channels = np.array(channels).transpose((1, 2, 0))  # 3x512x512 -> 512x512x3
+    channels = np.array(channels).transpose((1, 2, 0))  # 3xHxW -> HxWx3
 
     return np.clip(channels, 0, 1) * 255
 
 
-def motion_blur(x, severity=1):
+def motion_blur(x, severity=1, scale=1.):
     c = [(10, 3), (15, 5), (15, 8), (15, 12), (20, 15)][severity - 1]
 
-    output = BytesIO()
-    Image.fromarray(x).save(output, format='PNG')
-    x = MotionImage(blob=output.getvalue())
-
-    x.motion_blur(radius=c[0], sigma=c[1], angle=np.random.uniform(-45, 45))
-
-    x = cv2.imdecode(np.fromstring(x.make_blob(), np.uint8),
-                     cv2.IMREAD_UNCHANGED)
+    x = _motion_blur(x, radius=c[0] * scale, sigma=c[1] * scale, angle=np.random.uniform(-45, 45))
 
-    if x.shape != (512, 512):
-        return np.clip(x[..., [2, 1, 0]], 0, 255)  # BGR to RGB
+    if x.ndim == 3:
+        return np.clip(x, 0, 255)
     else:  # greyscale to RGB
         return np.clip(np.array([x, x, x]).transpose((1, 2, 0)), 0, 255)
 
@@ -220,39 +362,41 @@ def zoom_blur(x, severity=1):
     return np.clip(x, 0, 1) * 255
 
 
+fog_params = [(1.5, 2), (2., 2), (2.5, 1.7), (2.5, 1.5), (3., 1.4)]
+
+
 def fog(x, severity=1):
-    c = [(1.5, 2), (2., 2), (2.5, 1.7), (2.5, 1.5), (3., 1.4)][severity - 1]
+    c = fog_params[severity - 1]
 
     x = np.array(x) / 255.
     max_val = x.max()
-    x += c[0] * plasma_fractal(wibbledecay=c[1])[:512, :512][..., np.newaxis]
+    h, w = x.shape[:2]
+    x += c[0] * fractal_pool.sample(fractal_size(x.shape), c[1])[:h, :w][..., np.newaxis]
     return np.clip(x * max_val / (max_val + c[0]), 0, 1) * 255
 
 
-def frost(x, severity=1):
+def frost(x, severity=1, scale=1.):
     c = [(1, 0.4),
          (0.8, 0.6),
          (0.7, 0.7),
          (0.65, 0.7),
          (0.6, 0.75)][severity - 1]
-    idx = np.random.randint(5)
-    filename = [resource_filename(__name__, 'frost/frost1.png'),
-                resource_filename(__name__, 'frost/frost2.png'),
-                resource_filename(__name__, 'frost/frost3.png'),
-                resource_filename(__name__, 'frost/frost4.jpg'),
-                resource_filename(__name__, 'frost/frost5.jpg'),
-                resource_filename(__name__, 'frost/frost6.jpg')][idx]
-    frost = cv2.imread(filename)
-    # randomly crop and convert to rgb
+    h, w = np.shape(x)[:2]
+    idx = np.random.randint(len(frost_textures()))
+    frost = frost_textures()[idx]
+    # grow the texture if the frame does not fit in it
+    scale = max(scale, (h + 1.) / frost.shape[0], (w + 1.) / frost.shape[1])
+    frost = frost_texture(idx, math.ceil(scale * 100) / 100. if scale != 1 else 1)
+    # randomly crop, the textures are already rgb
 
-    x_start, y_start = np.random.randint(0, frost.shape[0] - 512), np.random.randint(0, frost.shape[1] - 512)
+    x_start, y_start = np.random.randint(0, frost.shape[0] - h), np.random.randint(0, frost.shape[1] - w)
 
-    frost = frost[x_start:x_start + 512, y_start:y_start + 512][..., [2, 1, 0]]
+    frost = frost[x_start:x_start + h, y_start:y_start + w]
 
     return np.clip(c[0] * np.array(x) + c[1] * frost, 0, 255)
 
 
-def snow(x, severity=1):
+def snow(x, severity=1, scale=1.):
     c = [(0.1, 0.3, 3, 0.5, 10, 4, 0.8),
          (0.2, 0.3, 2, 0.5, 12, 4, 0.7),
          (0.55, 0.3, 4, 0.9, 12, 8, 0.7),
@@ -265,22 +409,16 @@ def snow(x, severity=1):
     snow_layer = clipped_zoom(snow_layer[..., np.newaxis], c[2])
     snow_layer[snow_layer < c[3]] = 0
 
-    snow_layer = PILImage.fromarray((np.clip(snow_layer.squeeze(), 0, 1) * 255).astype(np.uint8), mode='L')
-    output = BytesIO()
-    snow_layer.save(output, format='PNG')
-    snow_layer = MotionImage(blob=output.getvalue())
-
-    snow_layer.motion_blur(radius=c[4], sigma=c[5], angle=np.random.uniform(-135, -45))
-
-    snow_layer = cv2.imdecode(np.fromstring(snow_layer.make_blob(), np.uint8),
-                              cv2.IMREAD_UNCHANGED) / 255.
+    snow_layer = (np.clip(snow_layer.squeeze(), 0, 1) * 255).astype(np.uint8)
+    snow_layer = _motion_blur(snow_layer, radius=c[4] * scale, sigma=c[5] * scale,
+                              angle=np.random.uniform(-135, -45)) / 255.
     snow_layer = snow_layer[..., np.newaxis]
 
-    x = c[6] * x + (1 - c[6]) * np.maximum(x, cv2.cvtColor(x, cv2.COLOR_RGB2GRAY).reshape(512, 512, 1) * 1.5 + 0.5)
+    x = c[6] * x + (1 - c[6]) * np.maximum(x, cv2.cvtColor(x, cv2.COLOR_RGB2GRAY)[..., np.newaxis] * 1.5 + 0.5)
     return np.clip(x + snow_layer + np.rot90(snow_layer, k=2), 0, 1) * 255
 
 
-def spatter(x, severity=1):
+def spatter(x, severity=1, scale=1.):
     c = [(0.65, 0.3, 4, 0.69, 0.6, 0),
          (0.65, 0.3, 3, 0.68, 0.6, 0),
          (0.65, 0.3, 2, 0.68, 0.5, 0),
@@ -290,7 +428,7 @@ def spatter(x, severity=1):
 
     liquid_layer = np.random.normal(size=x.shape[:2], loc=c[0], scale=c[1])
 
-    liquid_layer = gaussian(liquid_layer, sigma=c[2])
+    liquid_layer = gaussian(liquid_layer, sigma=c[2] * scale)
     liquid_layer[liquid_layer < c[3]] = 0
     if c[5] == 0:
         liquid_layer = (liquid_layer * 255).astype(np.uint8)
@@ -318,7 +456,7 @@ def spatter(x, severity=1):
         return cv2.cvtColor(np.clip(x + m * color, 0, 1), cv2.COLOR_BGRA2BGR) * 255
     else:
         m = np.where(liquid_layer > c[3], 1, 0)
-        m = gaussian(m.astype(np.float32), sigma=c[4])
+        m = gaussian(m.astype(np.float32), sigma=c[4] * scale)
         m[m < 0.8] = 0
 
         # mud brown
@@ -375,21 +513,23 @@ def jpeg_compression(x, severity=1):
 
 def pixelate(x, severity=1):
     c = [0.6, 0.5, 0.4, 0.3, 0.25][severity - 1]
+    h, w = x.shape[:2]
     x = Image.fromarray(x)
     
-    x = x.resize((int(512 * c), int(512 * c)),resample=Image.BILINEAR)
-    x = x.resize((512, 512),Image.NEAREST)
+    x = x.resize((int(w * c), int(h * c)),resample=Image.BILINEAR)
+    x = x.resize((w, h),Image.NEAREST)
 
     return np.array(x)
 
 
 # mod of https://gist.github.com/erniejunior/601cdf56d2b424757de5
-def elastic_transform(image, severity=1):
+def elastic_transform(image, severity=1, scale=1.):
     c = [(244 * 2, 244 * 0.7, 244 * 0.1),  # 244 should have been 512, but ultimately nothing is incorrect
          (244 * 2, 244 * 0.08, 244 * 0.2),
          (244 * 0.05, 244 * 0.01, 244 * 0.02),
          (244 * 0.07, 244 * 0.01, 244 * 0.02),
          (244 * 0.12, 244 * 0.01, 244 * 0.02)][severity - 1]
+    c = [v * scale for v in c]
 
     image = np.array(image, dtype=np.float32) / 255.
     shape = image.shape
@@ -0,0 +1,80 @@
+import yaml
+from ptsemseg.degredations import key2deg, spatial_deg, magnitude_deg, shaped_assets, prepare_assets
+from ptsemseg.degredations.torch_degredations import key2deg_torch
+
+
+class degradationPlan(object):
+    """Parsed degradation of a ``CONDITION__{...}`` subsplit.
+
+    The spec, e.g. ``{'channel':'rgb','type':'fog','value':'3'}``, is parsed
+    and validated once when the loader is built; calling the plan applies
+    the corruption to the selected channels of one frame. ``scale`` is the
+    ratio of the frame to its original resolution, pixel sized parameters
+    of spatial corruptions are multiplied by it.
+    """
+
+    def __init__(self, type, severity, channel):
+        if type not in key2deg:
+            raise ValueError("Corruption type {} not implemented, expected one of {}".format(
+                type, ", ".join(key2deg.keys())))
+        if "rgb" not in channel and "d" not in channel:
+            raise ValueError("Corruption channel {} selects neither rgb nor d".format(channel))
+        severity = int(severity)
+        if type in magnitude_deg:
+            if severity < 0:
+                raise ValueError("Corruption value {} of {} must be non-negative".format(severity, type))
+        elif not 1 <= severity <= 5:
+            raise ValueError("Corruption severity {} of {} must be in 1..5".format(severity, type))
+        self.type = type
+        self.severity = severity
+        self.channel = channel
+        self.fn = key2deg[type]
+        self.batch_fn = key2deg_torch.get(type)
+        self.rgb = "rgb" in channel
+        self.d = "d" in channel
+
+    @classmethod
+    def parse(cls, spec):
+        attr = yaml.safe_load(spec)
+        if not isinstance(attr, dict) or not all(k in attr for k in ["type", "value", "channel"]):
+            raise ValueError("Degradation spec {} needs 'type', 'value' and 'channel'".format(spec))
+        return cls(attr["type"], attr["value"], str(attr["channel"]))
+
+    def __call__(self, img, depth, scale=1.):
+        kwargs = {'scale': scale} if scale != 1 and self.type in spatial_deg else {}
+        if self.rgb:
+            img = self.fn(img, self.severity, **kwargs)
+        if self.d:
+            depth = self.fn(depth, self.severity, **kwargs)
+        return img, depth
+
+    def prepare(self, shape=None):
+        """Load shared assets (fractal pools, frost textures) before workers fork.
+
+        :param shape: (h, w) of the frames, if known
+        """
+        prepare_assets(self.type, self.severity, shape)
+
+    @property
+    def needs_shape(self):
+        """True if prepare needs the frame shape to build the assets."""
+        return self.type in shaped_assets
+
+    @property
+    def batched(self):
+        return self.batch_fn is not None
+
+    def apply_batch(self, img, depth, generators, scale=1.):
+        """Torch counterpart of __call__ for float NCHW batches in [0, 255].
+
+        :param generators: one torch.Generator per sample
+        """
+        kwargs = {'scale': scale} if scale != 1 and self.type in spatial_deg else {}
+        if self.rgb:
+            img = self.batch_fn(img, self.severity, generators, **kwargs)
+        if self.d:
+            depth = self.batch_fn(depth, self.severity, generators, **kwargs)
+        return img, depth
+
+    def __repr__(self):
+        return "degradationPlan(type={}, severity={}, channel={})".format(self.type, self.severity, self.channel)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Batched torch versions of the corruptions in degredations.py.
+
+Every corruption takes a float NCHW batch in [0, 255] on any device, the
+severity and one torch.Generator per sample, and returns a float batch in
+[0, 255]. Parameters follow the NumPy versions; the blurs take the same
+``scale`` as theirs to rescale pixel sized parameters to the resolution of
+the batch.
+"""
+
+import collections
+import numpy as np
+import torch
+import torch.nn.functional as F
+from ptsemseg.degredations.degredations import disk, motion_blur_kernel
+
+
+def make_generators(seeds, device):
+    return [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+
+
+def _rand(x, generators, fn=torch.rand, shape=None):
+    # one draw per sample so results do not depend on how samples are batched
+    shape = x.shape[1:] if shape is None else shape
+    return torch.stack([fn(shape, generator=g, device=x.device) for g in generators])
+
+
+def _uniform(generators, low, high, device):
+    return [low + (high - low) * torch.rand(1, generator=g, device=device).item() for g in generators]
+
+
+def _filter(x, kernel, padding_mode):
+    # depthwise correlation with a (kh, kw) kernel, same output size
+    kernel = torch.as_tensor(kernel, dtype=x.dtype, device=x.device)
+    kh, kw = kernel.shape
+    n, c, h, w = x.shape
+    x = F.pad(x, [(kw - 1) // 2, kw // 2, (kh - 1) // 2, kh // 2], mode=padding_mode)
+    weight = kernel.expand(c, 1, kh, kw)
+    return F.conv2d(x, weight, groups=c)
+
+
+def _gaussian_kernel1d(sigma, truncate=4.0):
+    radius = int(truncate * sigma + 0.5)
+    k = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    return k / k.sum()
+
+
+def _gaussian(x, sigma):
+    # skimage.filters.gaussian defaults: truncate=4, mode='nearest'
+    k = _gaussian_kernel1d(sigma)
+    x = _filter(x, k[None, :], 'replicate')
+    return _filter(x, k[:, None], 'replicate')
+
+
+def _value_saturation(x):
+    v = x.max(1, keepdim=True)[0]
+    delta = v - x.min(1, keepdim=True)[0]
+    s = torch.where(v > 0, delta / v.clamp(min=1e-12), torch.zeros_like(v))
+    return v, s
+
+
+# /////////////// Corruptions ///////////////
+
+def gaussian_noise(x, severity, generators):
+    c = [.08, .12, 0.18, 0.26, 0.38][severity - 1]
+
+    x = x / 255.
+    return (x + c * _rand(x, generators, torch.randn)).clamp(0, 1) * 255
+
+
+def shot_noise(x, severity, generators):
+    c = [60, 25, 12, 5, 3][severity - 1]
+
+    x = x / 255. * c
+    x = torch.stack([torch.poisson(x[i], generator=g) for i, g in enumerate(generators)])
+    return (x / float(c)).clamp(0, 1) * 255
+
+
+def impulse_noise(x, severity, generators):
+    c = [.03, .06, .09, 0.17, 0.27][severity - 1]
+
+    x = x / 255.
+    flipped = _rand(x, generators) < c
+    salted = _rand(x, generators) < 0.5
+    x = torch.where(flipped, salted.to(x.dtype), x)
+    return x.clamp(0, 1) * 255
+
+
+def speckle_noise(x, severity, generators):
+    c = [.15, .2, 0.35, 0.45, 0.6][severity - 1]
+
+    x = x / 255.
+    return (x + x * c * _rand(x, generators, torch.randn)).clamp(0, 1) * 255
+
+
+def gaussian_blur(x, severity, generators, scale=1.):
+    c = [1, 2, 3, 4, 6][severity - 1]
+
+    return _gaussian(x / 255., c * scale).clamp(0, 1) * 255
+
+
+def defocus_blur(x, severity, generators, scale=1.):
+    c = [(3, 0.1), (4, 0.5), (6, 0.5), (8, 0.5), (10, 0.5)][severity - 1]
+    if scale != 1:
+        c = (max(1, int(round(c[0] * scale))), c[1] * scale)
+
+    # cv2.filter2D default border is BORDER_REFLECT_101
+    x = _filter(x / 255., disk(radius=c[0], alias_blur=c[1]), 'reflect')
+    return x.clamp(0, 1) * 255
+
+
+def motion_blur(x, severity, generators, scale=1.):
+    c = [(10, 3), (15, 5), (15, 8), (15, 12), (20, 15)][severity - 1]
+
+    angles = _uniform(generators, -45, 45, x.device)
+    x = torch.cat([_filter(x[i:i + 1], motion_blur_kernel(c[0] * scale, c[1] * scale, angle), 'replicate')
+                   for i, angle in enumerate(angles)])
+    return x.clamp(0, 255)
+
+
+def contrast(x, severity, generators):
+    c = [0.4, .3, .2, .1, .05][severity - 1]
+
+    x = x / 255.
+    means = x.mean((2, 3), keepdim=True)
+    return ((x - means) * c + means).clamp(0, 1) * 255
+
+
+def brightness(x, severity, generators):
+    c = [.1, .2, .3, .4, .5][severity - 1]
+
+    # with hue and saturation fixed, rgb scales linearly with hsv value
+    x = x / 255.
+    v, _ = _value_saturation(x)
+    v_new = (v + c).clamp(0, 1)
+    x = torch.where(v > 0, x * v_new / v.clamp(min=1e-12), v_new.expand_as(x))
+    return x.clamp(0, 1) * 255
+
+
+def saturate(x, severity, generators):
+    c = [(0.3, 0), (0.1, 0), (2, 0), (5, 0.1), (20, 0.2)][severity - 1]
+
+    # every channel is v * (1 - s * k) with k depending only on the hue,
+    # grey pixels get hue 0 (red) like skimage.color.rgb2hsv
+    x = x / 255.
+    v, s = _value_saturation(x)
+    s_new = (s * c[0] + c[1]).clamp(0, 1)
+    coloured = v - (v - x) * s_new / s.clamp(min=1e-12)
+    red = torch.tensor([0., 1., 1.], dtype=x.dtype, device=x.device).view(1, 3, 1, 1)
+    grey = v * (1 - s_new * red)
+    x = torch.where(s > 0, coloured, grey)
+    return x.clamp(0, 1) * 255
+
+
+def pixelate(x, severity, generators):
+    c = [0.6, 0.5, 0.4, 0.3, 0.25][severity - 1]
+
+    h, w = x.shape[2:]
+    # area averaging stands in for PIL's antialiased bilinear downscale
+    x = F.interpolate(x, size=(int(h * c), int(w * c)), mode='area')
+    return F.interpolate(x, size=(h, w), mode='nearest')
+
+
+def blackoutNoise(x, severity, generators):
+    noise = severity + severity * _rand(x, generators, torch.randn)
+    return noise.round().clamp(0, 255)
+
+
+def additiveGaussianNoise(x, severity, generators):
+    # cv2.randn into a uint8 buffer rounds and saturates the noise
+    noise = (severity + severity * _rand(x, generators, torch.randn)).round().clamp(0, 255)
+    return (x + noise).clamp(0, 255)
+
+
+def occlusion(x, severity, generators):
+    n, _, h, w = x.shape
+    rows = torch.arange(h, dtype=x.dtype, device=x.device).view(h, 1)
+    cols = torch.arange(w, dtype=x.dtype, device=x.device).view(1, w)
+    masks = []
+    for g in generators:
+        u = torch.rand(3, generator=g, device=x.device).tolist()
+        # same draws as the NumPy version, which passes (x, y) to cv2.circle
+        col, row = int(h * u[0]), int(w * u[1])
+        r = int((min(h, w) / 4) * u[2] + (min(h, w) / 4))
+        masks.append(((rows - row) ** 2 + (cols - col) ** 2) > r ** 2)
+    return x * torch.stack(masks).unsqueeze(1).to(x.dtype)
+
+
+key2deg_torch = collections.OrderedDict()
+key2deg_torch['gaussianNoise'] = gaussian_noise
+key2deg_torch['shotNoise'] = shot_noise
+key2deg_torch['impulseNoise'] = impulse_noise
+key2deg_torch['speckleNoise'] = speckle_noise
+key2deg_torch['gaussianBlur'] = gaussian_blur
+key2deg_torch['defocusBlur'] = defocus_blur
+key2deg_torch['motionBlur'] = motion_blur
+key2deg_torch['contrast'] = contrast
+key2deg_torch['brightness'] = brightness
+key2deg_torch['saturate'] = saturate
+key2deg_torch['pixelate'] = pixelate
+key2deg_torch['blackoutNoise'] = blackoutNoise
+key2deg_torch['additiveGaussianNoise'] = additiveGaussianNoise
+key2deg_torch['occlusion'] = occlusion
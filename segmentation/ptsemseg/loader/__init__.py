@@ -3,6 +3,7 @@ import json
 from torch.utils import data
 
 from ptsemseg.loader.synthia_loader import synthiaLoader
+from ptsemseg.loader.device_transform import deviceTransform
 
 def get_loaders(name, cfg):
     data_loader = {
@@ -16,7 +17,17 @@ def get_loaders(name, cfg):
         split=cfg['data']['train_split'],
         subsplits=cfg['data']['train_subsplit'],
         scale_quantity=cfg['data']['train_reduction'],
-        img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']),)
+        img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']),
+        index_dir=cfg['data'].get('index_dir'),
+        shard_root=cfg['data'].get('shard_path'),
+        uint8=cfg['data'].get('uint8', False),
+        batch_degradation=cfg['data'].get('batch_degradation', False),
+        degradation_seed=cfg['data'].get('degradation_seed'),
+        degradation_cache=cfg['data'].get('degradation_cache'),
+        degradation_cache_size=(cfg['data'].get('degradation_cache_gb') or 20) * 2 ** 30,
+        fractal_pool_size=cfg['data'].get('fractal_pool_size') or 16,
+        degrade_after_resize=cfg['data'].get('degrade_after_resize', False),
+        norm_stats=cfg['data'].get('norm_stats'),)
         
 
     v_loader = {env: data_loader(
@@ -25,12 +36,23 @@ def get_loaders(name, cfg):
         split=cfg['data']['val_split'],
         subsplits=[env], 
         scale_quantity=cfg['data']['val_reduction'],
-        img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']), ) for env in cfg['data']['val_subsplit']}
+        img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']),
+        index_dir=cfg['data'].get('index_dir'),
+        shard_root=cfg['data'].get('shard_path'),
+        uint8=cfg['data'].get('uint8', False),
+        batch_degradation=cfg['data'].get('batch_degradation', False),
+        degradation_seed=cfg['data'].get('degradation_seed'),
+        degradation_cache=cfg['data'].get('degradation_cache'),
+        degradation_cache_size=(cfg['data'].get('degradation_cache_gb') or 20) * 2 ** 30,
+        fractal_pool_size=cfg['data'].get('fractal_pool_size') or 16,
+        degrade_after_resize=cfg['data'].get('degrade_after_resize', False),
+        norm_stats=cfg['data'].get('norm_stats'), ) for env in cfg['data']['val_subsplit']}
 
     n_classes = int(t_loader.n_classes)
     valloaders = {key: data.DataLoader(v_loader[key],
                                        batch_size=cfg['training']['batch_size'],
-                                       num_workers=cfg['training']['n_workers'],) for key in v_loader.keys()}
+                                       num_workers=cfg['training']['n_workers'],
+                                       pin_memory=cfg['data'].get('uint8', False),) for key in v_loader.keys()}
 
 
     return {
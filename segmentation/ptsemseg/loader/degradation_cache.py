@@ -0,0 +1,114 @@
+import os
+import zlib
+import hashlib
+import numpy as np
+from ptsemseg.degredations.degredations import asset_version
+
+
+def frame_seed(path, degradation, seed):
+    """Deterministic seed of one degraded frame, independent of worker and batch order."""
+    key = "{}|{}|{}|{}|{}".format(path, degradation.type, degradation.severity, degradation.channel, seed)
+    return zlib.crc32(key.encode("utf-8")) & 0xffffffff
+
+
+class degradationCache(object):
+    """Size bounded on-disk cache of degraded uint8 frames.
+
+    Entries are addressed by the source frame (path, size and mtime of the
+    RGB and depth files), the degradation (type, severity, channel), the
+    shared assets it draws from (the fog fractal pool) and the seed, and
+    hold the degraded rgb and depth frames (at ``size`` for frames degraded
+    after resizing, else at full resolution). Files are written
+    atomically, so workers of several loaders can share one directory; hits refresh the mtime and the least recently used entries
+    are evicted once the directory grows past ``max_bytes``.
+    """
+
+    suffix = ".npz"
+
+    def __init__(self, cache_dir, max_bytes=20 * 2 ** 30):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = int(max_bytes)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.size = None
+
+    def key(self, paths, degradation, seed, size=None):
+        h = hashlib.sha1()
+        for path in paths:
+            stat = os.stat(path)
+            h.update("{}|{}|{}\n".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+        h.update("{}|{}|{}|{}".format(degradation.type, degradation.severity, degradation.channel, seed).encode("utf-8"))
+        version = asset_version(degradation.type)
+        if version:
+            h.update("|{}".format(version).encode("utf-8"))
+        if size is not None:
+            # frames degraded after resizing
+            h.update("|{}x{}".format(size[0], size[1]).encode("utf-8"))
+        return h.hexdigest()
+
+    def path(self, key):
+        # two level fan out keeps directories small
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """Return (img, depth) or None on a miss."""
+        path = self.path(key)
+        try:
+            with np.load(path) as f:
+                img, depth = f["rgb"], f["d"]
+        except (IOError, OSError, KeyError, ValueError):
+            # missing, evicted by another worker or partially written by a crashed run
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return img, depth
+
+    def put(self, key, img, depth):
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, rgb=img, d=depth)
+        os.replace(tmp, path)
+
+        if self.size is None:
+            self.size = self.disk_usage()
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        for sub in os.listdir(self.cache_dir):
+            sub = os.path.join(self.cache_dir, sub)
+            if not os.path.isdir(sub):
+                continue
+            for name in os.listdir(sub):
+                if name.endswith(self.suffix):
+                    path = os.path.join(sub, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def disk_usage(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Delete least recently used entries down to 90% of max_bytes."""
+        entries = sorted(self.entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # already removed by another worker
+                pass
+            size -= entry_size
+        self.size = size
@@ -0,0 +1,51 @@
+import torch
+
+
+class deviceTransform(object):
+    """Batched counterpart of synthiaLoader.transform for uint8 batches.
+
+    Takes a collated (input_list, lbl_list) produced with ``uint8=True``,
+    moves the uint8 tensors to ``device`` and does the float cast,
+    mean/std normalisation and display copies there. The result has the
+    same layout as the float loader output. Loaders built with
+    ``batch_degradation=True`` pass their ``degrade_batch`` as ``degrade``,
+    which runs on the device before the display copies are taken.
+    """
+
+    def __init__(self, mean, std, device, img_norm=True, degrade=None):
+        self.device = device
+        self.img_norm = img_norm
+        self.degrade = degrade
+        mean = torch.tensor(mean, dtype=torch.float32, device=device).view(1, -1, 1, 1)
+        std = torch.tensor(std, dtype=torch.float32, device=device).view(1, -1, 1, 1)
+        self.mean = {'rgb': mean[:, :3], 'd': mean[:, 3:]}
+        self.std = {'rgb': std[:, :3], 'd': std[:, 3:]}
+
+    @classmethod
+    def from_loader(cls, loader, device):
+        degrade = loader.degrade_batch if getattr(loader, 'batch_degradation', False) else None
+        return cls(loader.mean, loader.std, device, img_norm=loader.img_norm, degrade=degrade)
+
+    def __call__(self, input_list, lbl_list, display=True):
+        inputs = {m: [x.to(self.device, non_blocking=True).float() for x in input_list[m]]
+                  for m in ['rgb', 'd']}
+        if self.degrade is not None:
+            for i, indices in enumerate(input_list['index']):
+                inputs['rgb'][i], inputs['d'][i] = self.degrade(inputs['rgb'][i], inputs['d'][i], indices)
+
+        outputs = {}
+        for m in ['rgb', 'd']:
+            outputs[m] = []
+            if display:
+                outputs[m + '_display'] = []
+            for x in inputs[m]:
+                if display:
+                    outputs[m + '_display'].append(x)
+                if self.img_norm:
+                    x = (x - self.mean[m]) / self.std[m]
+                outputs[m].append(x)
+        for key in input_list:
+            if key not in outputs:
+                outputs[key] = input_list[key]
+        lbl_list = [lbl.to(self.device, non_blocking=True).long() for lbl in lbl_list]
+        return outputs, lbl_list
@@ -0,0 +1,134 @@
+import os
+import glob
+import pickle
+import hashlib
+import random
+
+
+class synthiaIndex(object):
+    """Persistent manifest of the aligned SYNTHIA frames of a dataset root.
+
+    For every condition the manifest stores the aligned
+    (RGB, Depth, GT/COLOR, GT/LABELS) path tuples together with their
+    train/val/test assignment, so constructing a loader for any split or
+    subsplit is a dictionary lookup instead of 32 globs per condition.
+    A condition is re-globbed only when the mtime of one of its leaf
+    directories changes.
+    """
+
+    version = 1
+    split_ratios = {"train": 0.7, "val": 0.1, "test": 0.2}
+
+    def __init__(self, root, image_modes, cam_pos, sides, index_dir=None):
+        self.root = os.path.abspath(root)
+        self.image_modes = list(image_modes)
+        self.cam_pos = list(cam_pos)
+        self.sides = list(sides)
+        if index_dir is None:
+            index_dir = os.path.join(os.path.expanduser("~"), ".cache", "ptsemseg")
+        key = hashlib.md5(self.root.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(index_dir, "synthia_index_{}.pkl".format(key))
+        self.conditions = {}
+        self._checked = set()
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "rb") as fp:
+                manifest = pickle.load(fp)
+        except (EOFError, pickle.UnpicklingError):
+            print("Ignoring corrupt index {}".format(self.path))
+            return
+        if manifest.get("version") == self.version and manifest.get("root") == self.root:
+            self.conditions = manifest["conditions"]
+
+    def _save(self):
+        index_dir = os.path.dirname(self.path)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "wb") as fp:
+            pickle.dump({"version": self.version,
+                         "root": self.root,
+                         "conditions": self.conditions}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def _leaf_dirs(self, condition):
+        return [os.path.join(self.root, condition, mode, side, cam)
+                for mode in self.image_modes
+                for cam in self.cam_pos
+                for side in self.sides]
+
+    def _mtimes(self, condition):
+        mtimes = {}
+        for leaf in self._leaf_dirs(condition):
+            try:
+                mtimes[leaf] = os.stat(leaf).st_mtime
+            except OSError:
+                mtimes[leaf] = None
+        return mtimes
+
+    def _build(self, condition):
+        splits = {split: [] for split in self.split_ratios}
+        splits["all"] = []
+        for cam in self.cam_pos:
+            for side in self.sides:
+                names = {}
+                for mode in self.image_modes:
+                    files = glob.glob(os.path.join(self.root, condition, mode, side, cam, '*.png'))
+                    names[mode] = set(os.path.basename(f) for f in files)
+                    if mode == self.image_modes[0]:
+                        files_ref = files
+
+                # keep glob order and seed so the split matches the per-modality shuffles
+                files = [f for f in files_ref
+                         if all(os.path.basename(f) in names[mode] for mode in self.image_modes)]
+                random.Random(0).shuffle(files)
+
+                n = len(files)
+                n_train = int(self.split_ratios["train"] * n)
+                n_valid = int(self.split_ratios["val"] * n)
+                assignment = {"train": files[:n_train],
+                              "val": files[n_train:n_train + n_valid],
+                              "test": files[n_train + n_valid:]}
+                for split in ["train", "val", "test"]:
+                    for f in assignment[split]:
+                        name = os.path.basename(f)
+                        paths = tuple(os.path.join(self.root, condition, mode, side, cam, name)
+                                      for mode in self.image_modes)
+                        splits[split].append(paths)
+                        splits["all"].append(paths)
+        return splits
+
+    def lookup(self, condition, split):
+        """Return the aligned path tuples of ``condition`` assigned to ``split``.
+
+        Unknown split names return every frame of the condition, as the
+        glob-based loader did.
+        """
+        if condition not in self._checked:
+            mtimes = self._mtimes(condition)
+            entry = self.conditions.get(condition)
+            if entry is None or entry["mtimes"] != mtimes:
+                print("Indexing {}".format(os.path.join(self.root, condition)))
+                self.conditions[condition] = {"mtimes": mtimes, "splits": self._build(condition)}
+                try:
+                    self._save()
+                except OSError as e:
+                    print("Could not write index {}: {}".format(self.path, e))
+            self._checked.add(condition)
+        splits = self.conditions[condition]["splits"]
+        return splits.get(split, splits["all"])
+
+
+_indices = {}
+
+
+def get_index(root, image_modes, cam_pos, sides, index_dir=None):
+    """Process-wide shared synthiaIndex for ``root``."""
+    key = (os.path.abspath(root), index_dir)
+    if key not in _indices:
+        _indices[key] = synthiaIndex(root, image_modes, cam_pos, sides, index_dir=index_dir)
+    return _indices[key]
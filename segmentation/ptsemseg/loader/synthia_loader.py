@@ -5,7 +5,6 @@ import os
 import torch
 import numpy as np
 import scipy.misc as m
-import glob
 import cv2
 import time
 import matplotlib.pyplot as plt
@@ -17,6 +16,11 @@ import yaml
 from tqdm import tqdm
 import pickle
 from ptsemseg.degredations import *
+from ptsemseg.degredations.torch_degredations import make_generators
+from ptsemseg.loader.synthia_index import get_index
+from ptsemseg.loader.synthia_shards import synthiaShard, shard_dir
+from ptsemseg.loader.degradation_cache import degradationCache, frame_seed
+from ptsemseg.loader.synthia_stats import dataset_statistics, print_class_table
 random.seed(42)
 
 import ptsemseg.augmentations.augmentations as aug
@@ -113,7 +117,18 @@ class synthiaLoader(data.Dataset):
         img_size=(512, 512),
         scale_quantity=1.0,      
         img_norm=True,
-        version='synthia-seq'   
+        version='synthia-seq',
+        index_dir=None,
+        shard_root=None,
+        uint8=False,
+        display=True,
+        batch_degradation=False,
+        degradation_seed=None,
+        degradation_cache=None,
+        degradation_cache_size=20 * 2 ** 30,
+        fractal_pool_size=16,
+        degrade_after_resize=False,
+        norm_stats=None
     ):
         """__init__
 
@@ -122,6 +137,24 @@ class synthiaLoader(data.Dataset):
         :param is_transform:
         :param img_size:
         :param augmentations 
+        :param index_dir: directory of the persistent file index (default ~/.cache/ptsemseg)
+        :param shard_root: directory of pre-resized shards written by build_shards.py
+        :param uint8: emit resized uint8 CHW tensors without display copies and
+            leave casting/normalisation to ptsemseg.loader.deviceTransform
+        :param display: return rgb_display/d_display with every sample, see get_display
+        :param batch_degradation: with uint8, leave degradations that have a torch
+            implementation to deviceTransform, which applies them per batch after
+            the resize (samples then carry their 'index')
+        :param degradation_seed: seed every degraded frame from its file path, the
+            degradation and this value, so results do not depend on worker order
+        :param degradation_cache: directory of the degraded frame cache, implies
+            degradation_seed=0 if unset
+        :param degradation_cache_size: size bound of the cache in bytes
+        :param fractal_pool_size: number of pre-generated plasma fractals fog draws from
+        :param degrade_after_resize: resize frames to img_size before the per-frame
+            degradations and scale their pixel sized parameters accordingly
+        :param norm_stats: yaml written by dataset_stats.py whose mean_rgbd/std_rgbd
+            replace the built-in values of ``version``
         """
 
         self.root = root
@@ -129,151 +162,156 @@ class synthiaLoader(data.Dataset):
         self.subsplits = subsplits
         self.is_transform = is_transform
         self.img_norm = img_norm
+        self.uint8 = uint8
+        self.display = display
+        self.batch_degradation = batch_degradation and uint8
+        self.cache = None
+        if degradation_cache:
+            self.cache = degradationCache(degradation_cache, degradation_cache_size)
+            if degradation_seed is None:
+                degradation_seed = 0
+        self.degradation_seed = degradation_seed
+        self.degrade_after_resize = degrade_after_resize
+        self._source_shape = None
+        fractal_pool.configure(size=fractal_pool_size)
         self.n_classes = len(self.class_names)
         self.img_size = (img_size if isinstance(img_size, tuple) else (img_size, img_size))
         
         # split: train/val image_modes
         self.imgs = {image_mode:[] for image_mode in self.image_modes}
-        self.dgrd = {image_mode:[] for image_mode in self.image_modes}
+        self.dgrd = []
+        self.shard_rows = []
         self.mean = np.array(self.mean_rgbd[version])
         self.std = np.array(self.std_rgbd[version])
+        if norm_stats:
+            with open(norm_stats) as fp:
+                stats = yaml.safe_load(fp)
+            self.mean = np.array(stats['mean_rgbd'])
+            self.std = np.array(stats['std_rgbd'])
 
 
         # load RGB/Depth
+        index = get_index(self.root, self.image_modes, self.cam_pos, self.sides, index_dir=index_dir)
         for subsplit in self.subsplits:
             if len(subsplit.split("__")) == 2:
                 condition = subsplit.split("__")[0]
-                degradation = subsplit.split("__")[1]
+                degradation = degradationPlan.parse(subsplit.split("__")[1])
             else:
                 condition = subsplit
                 degradation = None
-            for comb_modal in self.image_modes:
-                for comb_cam in self.cam_pos:
-                    for side in self.sides:
-                        files = glob.glob(os.path.join(root,condition,comb_modal,side,comb_cam,'*.png'),recursive=True)
-                        random.seed(0)
-                        shuffle(files)
-                        # print(os.path.join(root,condition,comb_modal,side,comb_cam,'*.png'))
-                        # print(len(files))
-                        n = len(files)
-                        n_train = int(0.7 * n)
-                        #n_recal = int(0.1 * n)
-                        n_valid = int(0.1 * n)
-                        n_test = int(0.2 * n)
-                        
-                        if self.split == 'train':
-                            # import ipdb;ipdb.set_trace()
-                            files = files[:n_train]
-                        # if self.split == 'recal':
-                        #     files = files[n_train:n_train+n_recal]
-                        if self.split == 'val':
-                            files = files[n_train:n_train+n_valid]
-                        if self.split == 'test':
-                            files = files[n_train+n_valid:]
-                        for file_path in files:
-                            self.imgs[comb_modal].append(file_path)
-                            self.dgrd[comb_modal].append(degradation)
+            entries = index.lookup(condition, self.split)
+            shard = self.open_shard(shard_root, condition, degradation, entries)
+            for row, paths in enumerate(entries):
+                for comb_modal, file_path in zip(self.image_modes, paths):
+                    self.imgs[comb_modal].append(file_path)
+                self.dgrd.append(degradation)
+                self.shard_rows.append(None if shard is None else (shard, row))
         
         
         if not self.imgs[self.image_modes[0]]:
             raise Exception("No files for split=[%s] found in %s" % (self.split, self.root))
         print("{} {}: Found {} Images".format(self.split,self.subsplits,len(self.imgs[self.image_modes[0]])))
+        # build fractal pools and load textures before loader workers fork
+        for degradation in set(self.dgrd):
+            if degradation is not None and not self.deferred(degradation):
+                shape = None
+                if degradation.needs_shape:
+                    shape = (self.img_size[1], self.img_size[0]) if degrade_after_resize else self.source_shape()
+                degradation.prepare(shape)
         if scale_quantity != 1.0:
             for image_mode in self.image_modes:
                 self.imgs[image_mode] = self.imgs[image_mode][::int(1/scale_quantity)]
+            self.dgrd = self.dgrd[::int(1/scale_quantity)]
+            self.shard_rows = self.shard_rows[::int(1/scale_quantity)]
             print("{} {}: Reduced by {} to {} Images".format(self.split,self.subsplits,scale_quantity,len(self.imgs[self.image_modes[0]])))
 
 
         # self.dataset_statistics()
         # exit()
 
-    def dataset_statistics(self):
+    def open_shard(self, shard_root, condition, degradation, entries):
+        """Return the matching pre-resized shard, or None to decode the PNGs."""
+        if shard_root is None:
+            return None
+        out_dir = shard_dir(shard_root, self.split, condition, self.img_size)
+        if not synthiaShard.exists(out_dir):
+            print("No shard at {}, decoding {} from files".format(out_dir, condition))
+            return None
+        if degradation is not None and not self.deferred(degradation):
+            # degradations are defined on full resolution frames
+            print("{}: degraded subsplit, decoding from files".format(condition))
+            return None
+        shard = synthiaShard(out_dir)
+        if shard.paths != [paths[0] for paths in entries]:
+            print("Shard {} is out of date with the file index, decoding from files".format(out_dir))
+            return None
+        return shard
+
+    def deferred(self, degradation):
+        """True if the degradation is left to degrade_batch."""
+        return self.batch_degradation and degradation is not None and degradation.batched
+
+    def source_shape(self):
+        """(h, w) of the full resolution frames, read from the first RGB file."""
+        if self._source_shape is None:
+            self._source_shape = cv2.imread(self.imgs['RGB'][0]).shape[:2]
+        return self._source_shape
+
+    def degrade_batch(self, rgb, d, indices):
+        """Apply the deferred degradations of frames ``indices`` to float NCHW batches.
+
+        Each sample draws from a generator seeded like the per-frame path,
+        from its file path, the degradation and degradation_seed (0 if
+        unset), so a frame is degraded the same way whatever batch it lands in. The batches are
+        at img_size, so spatial parameters are scaled as with degrade_after_resize.
+        """
+        indices = [int(i) for i in indices]
+        groups = {}
+        for row, index in enumerate(indices):
+            degradation = self.dgrd[index]
+            if self.deferred(degradation):
+                groups.setdefault(degradation, []).append(row)
+        if not groups:
+            return rgb, d
+        rgb, d = rgb.clone(), d.clone()
+        raw_h, raw_w = self.source_shape()
+        scale = np.sqrt(float(self.img_size[0] * self.img_size[1]) / (raw_h * raw_w))
+        for degradation, rows in groups.items():
+            seeds = [frame_seed(self.imgs['RGB'][indices[row]], degradation, self.degradation_seed or 0)
+                     for row in rows]
+            generators = make_generators(seeds, rgb.device)
+            rows = torch.tensor(rows, device=rgb.device)
+            rgb[rows], d[rows] = degradation.apply_batch(rgb[rows], d[rows], generators, scale)
+        return rgb, d
+
+    def degrade(self, img, depth, degradation, img_path, scale=1.):
+        """Apply a per-frame degradation, seeded and quantised to uint8 when
+        degradation_seed/degradation_cache are set."""
+        if self.degradation_seed is not None:
+            seed = frame_seed(img_path, degradation, self.degradation_seed)
+            np.random.seed(seed)
+            cv2.setRNGSeed(seed & 0x7fffffff)
+        img, depth = degradation(img, depth, scale)
+        if self.cache is not None:
+            # cached frames are stored as uint8, fresh ones have to match them
+            img = np.clip(np.round(img), 0, 255).astype(np.uint8)
+            depth = np.clip(np.round(depth), 0, 255).astype(np.uint8)
+        return img, depth
 
+    def dataset_statistics(self, n_workers=8):
+        """Single pass channel mean/std and per-camera class fractions, see
+        ptsemseg.loader.synthia_stats (needs uint8=True)."""
         print("="*20)
         print("Running Dataset Statistics")
         print("="*20)
 
         print("Splits:    {}".format(self.split))
-        print("Positions: {}".format(", ".join(list(self.imgs.keys()))))
-
-        savefile = "{}_dataset_statistics.p".format(self.split)
-        savefile2 = "{}_pixels.p".format(self.split)
-
-
-        rgb_mean = []
-        rgb_std = []
-        d_mean = []
-        d_std = []
-        
-        from collections import defaultdict
-        
-        classes = defaultdict(int)
-        
-        for index in tqdm(range(int(1.0*len(self.imgs[self.image_modes[0]])))):
-            input_list, lbl_list = self.__getitem__(index)
-            img_list, aux_list = input_list['rgb'], input_list['d']
-            # shape (batch_size, 3, height, width)
-            numpy_image = torch.stack(img_list, 0).numpy()
-            numpy_depth = torch.stack(aux_list, 0).numpy()
-            
-            # shape (3,)
-            batch_mean = np.mean(numpy_image, axis=(0,2,3))
-            batch_std = np.std(numpy_image, axis=(0,2,3), ddof=1)
-            
-            rgb_mean.append(batch_mean)
-            rgb_std.append(batch_std)
-            
-            
-            # shape (3,)
-            batch_mean = np.mean(numpy_depth, axis=(0,2,3))
-            batch_std = np.std(numpy_depth, axis=(0,2,3), ddof=1)
-            
-            d_mean.append(batch_mean)
-            d_std.append(batch_std)
-            
-            
-            numpy_lbl = torch.stack(lbl_list, 0).reshape(-1).numpy()
-            for l in numpy_lbl:
-            
-                classes[l] += 1
-
-            
-
-        # shape (num_iterations, 3) -> (mean across 0th axis) -> shape (3,)
-        rgb_mean = np.array(rgb_mean).mean(axis=0)
-        rgb_std = np.array(rgb_std).mean(axis=0)
-        # shape (num_iterations, 3) -> (mean across 0th axis) -> shape (3,)
-        d_mean = np.array(d_mean).mean(axis=0)
-        d_std = np.array(d_std).mean(axis=0)
-        
-        print("rgb: mean - {}, std - {}".format(rgb_mean, rgb_std))
-        print("d: mean - {}, std - {}".format(d_mean, d_std))
-        print(classes)
-        # if os.path.isfile(savefile):
-        if False:
-            pixel_stats = pickle.load( open(savefile,"rb"))
-            pixel_dump = pickle.load( open(savefile2,"rb"))
-
-        else:        
-            pixel_stats = {p:{n:[] for n in self.name2id} for p in self.cam_pos}
-            
-            for index in tqdm(range(int(1.0*len(self.imgs[self.image_modes[0]])))):
-                input_list, lbl_list = self.__getitem__(index)
-                img_list, aux_list = input_list['rgb'], input_list['d']
-                
-                for i,p in enumerate(self.cam_pos):
-                    for n in self.name2id:
-                        pixel_stats[p][n].append( (1.*torch.sum(lbl_list[i]==self.name2id[n]).tolist()/(list(lbl_list[i].size())[0]*list(lbl_list[i].size())[1])) ) 
-                
-            
-            pickle.dump(pixel_stats, open(savefile,"wb"))
-        
-        pixel_stats_summary = {p:{n:{"mean":0} for n in self.name2id} for p in self.cam_pos}
-        for i,p in enumerate(self.cam_pos):
-            for n in self.name2id:
-                pixel_stats_summary[p][n]["mean"] = np.mean(pixel_stats[p][n])
-                pixel_stats_summary[p][n]["var"] = np.std(pixel_stats[p][n])
+        print("Subsplits: {}".format(", ".join(self.subsplits)))
 
+        stats = dataset_statistics(self, n_workers=n_workers)
+        print("rgbd: mean - {}, std - {}".format(stats['mean_rgbd'], stats['std_rgbd']))
+        print_class_table(stats, self.class_names)
+        return stats
 
 
     def tuple_to_folder_name(self, path_tuple):
@@ -292,74 +330,109 @@ class synthiaLoader(data.Dataset):
 
         :param index:
         """
+        return self.load(index, self.display)
+
+    def get_display(self, input_list):
+        """Display tensors of a collated float batch, for loaders built with display=False.
+
+        The normalisation of the inputs is undone, so the display shows the
+        frames (and degradations) the model was given.
+        """
+        display = {}
+        for m, mean, std in [('rgb', self.mean[:3], self.std[:3]), ('d', self.mean[3:], self.std[3:])]:
+            x = input_list[m][0]
+            if self.img_norm:
+                mean = torch.tensor(mean, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+                std = torch.tensor(std, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+                x = x * std + mean
+            display[m + '_display'] = x
+        return display
+
+    def load(self, index, display):
         input_list = {'rgb':[], 
-                      'd': [],
-                      'rgb_display': [],
-                      'd_display': []}
+                      'd': []}
+        display = display and not self.uint8
+        if display:
+            input_list['rgb_display'] = []
+            input_list['d_display'] = []
         lbl_list = []
         start_ts = time.time()
 
-        img_path = self.imgs['RGB'][index]
-        lbl_path = self.imgs['GT/LABELS'][index]
-        lbl_color_path = self.imgs['GT/COLOR'][index]            
-        
-        img = np.array(cv2.imread(img_path),dtype=np.uint8)[:,:,:3]
-        lbl = np.array(cv2.imread(lbl_path,cv2.IMREAD_UNCHANGED))[:,:,2]
-        lbl_color = np.array(cv2.imread(lbl_color_path),dtype=np.uint8)[:,:,:3]
-        
+        degradation = self.dgrd[index]
+        if self.deferred(degradation):
+            degradation = None
+        if self.batch_degradation:
+            input_list['index'] = [index]
 
-        depth_path = self.imgs['Depth'][index]
-        # depth = np.array(cv2.imread(depth_path),dtype=np.uint8)
-        
-        depth = cv2.imread(depth_path, cv2.IMREAD_GRAYSCALE)
-        depth = np.array(cv2.applyColorMap(depth, cv2.COLORMAP_JET))
+        if self.shard_rows[index] is not None:
+            # open_shard only keeps shards of clean or deferred subsplits
+            shard, row = self.shard_rows[index]
+            img, lbl, depth = shard[row]
+        else:
+            img_path = self.imgs['RGB'][index]
+            lbl_path = self.imgs['GT/LABELS'][index]
+            depth_path = self.imgs['Depth'][index]
+
+            lbl = np.array(cv2.imread(lbl_path,cv2.IMREAD_UNCHANGED))[:,:,2]
+            resize = degradation is not None and self.degrade_after_resize
+            if resize:
+                lbl = cv2.resize(lbl, (self.img_size[0], self.img_size[1]), interpolation=cv2.INTER_NEAREST)
+            cached = None
+            if degradation is not None and self.cache is not None:
+                key = self.cache.key((img_path, depth_path), degradation, self.degradation_seed,
+                                     self.img_size if resize else None)
+                cached = self.cache.get(key)
+            if cached is not None:
+                img, depth = cached
+            else:
+                img = np.array(cv2.imread(img_path),dtype=np.uint8)[:,:,:3]
+                depth = cv2.imread(depth_path, cv2.IMREAD_GRAYSCALE)
+                depth = np.array(cv2.applyColorMap(depth, cv2.COLORMAP_JET))
+                if degradation is not None:
+                    scale = 1.
+                    if resize:
+                        scale = np.sqrt(float(self.img_size[0] * self.img_size[1]) / (img.shape[0] * img.shape[1]))
+                        img = cv2.resize(img, (self.img_size[0], self.img_size[1]))
+                        depth = cv2.resize(depth, (self.img_size[0], self.img_size[1]))
+                    img, depth = self.degrade(img, depth, degradation, img_path, scale)
+                    if self.cache is not None:
+                        self.cache.put(key, img, depth)
         # cv2.imwrite('messigray.png',depth)
-        degradation = self.dgrd['RGB'][index]
-        if not degradation is None:
-            img, depth = self.degradation(degradation, img, depth)
-        if self.is_transform:
-            img, lbl, depth, img_display, depth_display = self.transform(img, lbl, depth)
+        if self.uint8:
+            img, lbl, depth = self.transform_uint8(img, lbl, depth)
+        elif self.is_transform:
+            img, lbl, depth, img_display, depth_display = self.transform(img, lbl, depth, display=display)
+            if display:
+                input_list['rgb_display'].append(img_display)
+                input_list['d_display'].append(depth_display)
         input_list['rgb'].append(img)
         input_list['d'].append(depth)
-        input_list['rgb_display'].append(img_display)
-        input_list['d_display'].append(depth_display)
         
         lbl_list.append(lbl)
         
         return input_list, lbl_list
 
 
-    def degradation(self, degradation, img, depth):
-
-        degradation = yaml.load((degradation))
-        if degradation['type'] in key2deg.keys():
-            if "rgb" in degradation['channel']:
-                img = key2deg[degradation['type']](img, int(degradation['value']))
-            if "d" in degradation['channel']:
-                depth = key2deg[degradation['type']](depth, int(degradation['value']))
-        else:
-            print("Corruption Type Not Implemented")
-            
-        return img, depth
-
-
-    def transform(self, img, lbl, aux):
+    def transform(self, img, lbl, aux, display=True):
         """transform
         :param img:
         :param lbl:
+        :param display: also return the unnormalised display tensors, else None
         """
 
         
         # if img.dtype == 'uint8':   
-        img = cv2.resize(img, (self.img_size[0], self.img_size[1]))  # uint8 with RGB mode
-        aux = cv2.resize(aux, (self.img_size[0], self.img_size[1]))  # uint8 with RGB mode
+        resize = img.shape[:2] != (self.img_size[1], self.img_size[0])
+        if resize:
+            img = cv2.resize(img, (self.img_size[0], self.img_size[1]))  # uint8 with RGB mode
+            aux = cv2.resize(aux, (self.img_size[0], self.img_size[1]))  # uint8 with RGB mode
         # img = img[:, :, ::-1]  # RGB -> BGR
 
         img = img.astype(np.float64)
         aux = aux.astype(np.float64)
         
-        img_display = img.copy()
-        aux_display = aux.copy()
+        img_display = img.copy() if display else None
+        aux_display = aux.copy() if display else None
 
         if self.img_norm:
             img = np.divide((img.astype(float) - self.mean[:3]),self.std[:3])
@@ -367,15 +440,14 @@ class synthiaLoader(data.Dataset):
 
         # NHWC -> NCHW
         img = img.transpose(2, 0, 1)
-        img_display = img_display.transpose(2, 0, 1)
 
         if not any(['depth_encoded'==mode for mode in self.image_modes]):
             aux = aux.transpose(2, 0, 1)
-            aux_display = aux_display.transpose(2, 0, 1)
 
         classes = np.unique(lbl)
-        lbl = lbl.astype(float)
-        lbl = cv2.resize(lbl, (self.img_size[0], self.img_size[1]), interpolation=cv2.INTER_NEAREST) #, "nearest", mode="F")
+        if resize:
+            lbl = lbl.astype(float)
+            lbl = cv2.resize(lbl, (self.img_size[0], self.img_size[1]), interpolation=cv2.INTER_NEAREST) #, "nearest", mode="F")
         lbl = lbl.astype(int)
 
         # if not np.all(classes == np.unique(lbl)):
@@ -387,13 +459,38 @@ class synthiaLoader(data.Dataset):
         
         img = torch.from_numpy(img).float()
         aux = torch.from_numpy(aux).float()
-        img_display = torch.from_numpy(img_display).float()
-        aux_display = torch.from_numpy(aux_display).float()
+        if display:
+            img_display = torch.from_numpy(img_display.transpose(2, 0, 1)).float()
+            aux_display = torch.from_numpy(aux_display.transpose(2, 0, 1)).float()
         lbl = torch.from_numpy(lbl).long()
         # else:
         #     import ipdb;ipdb.set_trace() 
         return img, lbl, aux, img_display, aux_display
 
+    def transform_uint8(self, img, lbl, aux):
+        """transform_uint8
+
+        Resize only and return uint8 CHW tensors; labels are uint8 as well
+        since class ids fit in a byte. Degraded (float) frames are rounded.
+        """
+        if img.shape[:2] != (self.img_size[1], self.img_size[0]):
+            img = cv2.resize(img, (self.img_size[0], self.img_size[1]))
+            aux = cv2.resize(aux, (self.img_size[0], self.img_size[1]))
+            lbl = cv2.resize(lbl, (self.img_size[0], self.img_size[1]), interpolation=cv2.INTER_NEAREST)
+        if img.dtype != np.uint8:
+            img = np.clip(np.round(img), 0, 255).astype(np.uint8)
+        if aux.dtype != np.uint8:
+            aux = np.clip(np.round(aux), 0, 255).astype(np.uint8)
+
+        if not np.all(np.unique(lbl[lbl != self.ignore_index]) < self.n_classes):
+            print("after det", np.unique(lbl))
+            raise ValueError("Segmentation map contained invalid class values")
+
+        img = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+        aux = torch.from_numpy(np.ascontiguousarray(aux.transpose(2, 0, 1)))
+        lbl = torch.from_numpy(np.ascontiguousarray(lbl, dtype=np.uint8))
+        return img, lbl, aux
+
     # def get_cls_num_list(self):
     #     cls_num_list = []
     #     cls_num_dict = Counter(self.classes)
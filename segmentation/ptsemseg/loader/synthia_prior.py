@@ -0,0 +1,43 @@
+import cv2
+import numpy as np
+from torch.utils import data
+from tqdm import tqdm
+
+
+class labelHistogram(data.Dataset):
+    """Class histogram of every GT/LABELS frame of a synthiaLoader.
+
+    Only the labels are read, from the loader's shard when it has one, else
+    from the PNG resized to img_size like synthiaLoader.transform does.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getitem__(self, index):
+        loader = self.loader
+        if loader.shard_rows[index] is not None:
+            shard, row = loader.shard_rows[index]
+            # memory-mapped, only the label plane is read
+            lbl = np.asarray(shard[row][1])
+        else:
+            lbl = np.array(cv2.imread(loader.imgs['GT/LABELS'][index], cv2.IMREAD_UNCHANGED))[:, :, 2]
+            if lbl.shape[:2] != (loader.img_size[1], loader.img_size[0]):
+                lbl = cv2.resize(lbl, (loader.img_size[0], loader.img_size[1]), interpolation=cv2.INTER_NEAREST)
+        return np.bincount(lbl.ravel(), minlength=loader.n_classes)[:loader.n_classes]
+
+
+def _single(batch):
+    return batch[0]
+
+
+def class_counts(loader, n_workers=8):
+    """Pixel count per class over all frames of ``loader``."""
+    counts = np.zeros(loader.n_classes, dtype=np.int64)
+    frames = data.DataLoader(labelHistogram(loader), batch_size=1, num_workers=n_workers, collate_fn=_single)
+    for hist in tqdm(frames):
+        counts += hist
+    return counts
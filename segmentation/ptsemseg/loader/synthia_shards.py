@@ -0,0 +1,108 @@
+import os
+import pickle
+import numpy as np
+import cv2
+from multiprocessing import Pool
+from tqdm import tqdm
+
+
+def shard_dir(shard_root, split, condition, img_size):
+    return os.path.join(shard_root, split, condition, "{}x{}".format(img_size[0], img_size[1]))
+
+
+def read_frame(paths, img_size):
+    """Decode and resize one aligned (RGB, Depth, GT/COLOR, GT/LABELS) tuple.
+
+    Mirrors synthiaLoader.__getitem__/transform: depth is colour-mapped
+    before resizing and labels are resized with nearest neighbour.
+    img_size follows the loader convention, i.e. (width, height) for cv2.
+    """
+    img_path, depth_path, _, lbl_path = paths
+    img = np.array(cv2.imread(img_path), dtype=np.uint8)[:, :, :3]
+    depth = cv2.imread(depth_path, cv2.IMREAD_GRAYSCALE)
+    depth = cv2.applyColorMap(depth, cv2.COLORMAP_JET)
+    lbl = np.array(cv2.imread(lbl_path, cv2.IMREAD_UNCHANGED))[:, :, 2]
+
+    img = cv2.resize(img, (img_size[0], img_size[1]))
+    depth = cv2.resize(depth, (img_size[0], img_size[1]))
+    lbl = cv2.resize(lbl, (img_size[0], img_size[1]), interpolation=cv2.INTER_NEAREST)
+    return img, depth, lbl.astype(np.uint8)
+
+
+def _read_frame(args):
+    return read_frame(*args)
+
+
+def write_shard(entries, out_dir, img_size, n_workers=4):
+    """Write pre-resized uint8 rgb/depth/label arrays for ``entries``.
+
+    :param entries: aligned path tuples as returned by synthiaIndex.lookup
+    :param out_dir: shard directory, see shard_dir
+    :param img_size: (width, height) of the stored frames
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    n = len(entries)
+    w, h = img_size
+    rgb = np.lib.format.open_memmap(os.path.join(out_dir, "rgb.npy"), mode="w+", dtype=np.uint8, shape=(n, h, w, 3))
+    depth = np.lib.format.open_memmap(os.path.join(out_dir, "depth.npy"), mode="w+", dtype=np.uint8, shape=(n, h, w, 3))
+    labels = np.lib.format.open_memmap(os.path.join(out_dir, "labels.npy"), mode="w+", dtype=np.uint8, shape=(n, h, w))
+
+    pool = Pool(n_workers)
+    try:
+        frames = pool.imap(_read_frame, [(paths, img_size) for paths in entries], chunksize=8)
+        for i, (img, dep, lbl) in enumerate(tqdm(frames, total=n)):
+            rgb[i] = img
+            depth[i] = dep
+            labels[i] = lbl
+    finally:
+        pool.close()
+        pool.join()
+    for array in [rgb, depth, labels]:
+        array.flush()
+    del rgb, depth, labels
+
+    # meta is written last so a half-written shard is never picked up
+    with open(os.path.join(out_dir, "meta.pkl"), "wb") as fp:
+        pickle.dump({"paths": [paths[0] for paths in entries], "img_size": tuple(img_size)}, fp)
+
+
+class synthiaShard(object):
+    """Read-only view of one (split, condition, img_size) shard.
+
+    Arrays are memory-mapped lazily per process so forked DataLoader
+    workers do not share file handles.
+    """
+
+    def __init__(self, out_dir):
+        self.dir = out_dir
+        with open(os.path.join(out_dir, "meta.pkl"), "rb") as fp:
+            meta = pickle.load(fp)
+        self.paths = meta["paths"]
+        self.img_size = meta["img_size"]
+        self._pid = None
+
+    @staticmethod
+    def exists(out_dir):
+        return os.path.isfile(os.path.join(out_dir, "meta.pkl"))
+
+    def _open(self):
+        if self._pid != os.getpid():
+            self.rgb = np.load(os.path.join(self.dir, "rgb.npy"), mmap_mode="r")
+            self.depth = np.load(os.path.join(self.dir, "depth.npy"), mmap_mode="r")
+            self.labels = np.load(os.path.join(self.dir, "labels.npy"), mmap_mode="r")
+            self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, row):
+        self._open()
+        return self.rgb[row], self.labels[row], self.depth[row]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["rgb", "depth", "labels"]:
+            state.pop(key, None)
+        state["_pid"] = None
+        return state
@@ -0,0 +1,76 @@
+import os
+import numpy as np
+from torch.utils import data
+from tqdm import tqdm
+from ptsemseg.metrics import runningMoments
+
+
+def camera(path):
+    # <root>/<condition>/RGB/<side>/<camera>/<frame>.png
+    return os.path.basename(os.path.dirname(path))
+
+
+class frameStatistics(data.Dataset):
+    """Per-frame channel moments and label histogram of a uint8 synthiaLoader.
+
+    Each item is small (a few arrays of length C or n_classes), so frames
+    are decoded and reduced in the DataLoader workers and only merged in
+    the main process.
+    """
+
+    def __init__(self, loader):
+        if not loader.uint8:
+            raise ValueError("Dataset statistics need a synthiaLoader built with uint8=True")
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getitem__(self, index):
+        input_list, lbl_list = self.loader.load(index, False)
+        lbl = lbl_list[0].numpy().ravel()
+        return {'rgb': runningMoments.moments(input_list['rgb'][0].numpy()),
+                'd': runningMoments.moments(input_list['d'][0].numpy()),
+                'hist': np.bincount(lbl, minlength=self.loader.n_classes)[:self.loader.n_classes]}
+
+
+def _single(batch):
+    return batch[0]
+
+
+def dataset_statistics(loader, n_workers=8):
+    """Single pass mean/std of rgb and depth and class histograms per camera.
+
+    :param loader: synthiaLoader built with uint8=True, frames are measured
+        at img_size before normalisation like mean_rgbd/std_rgbd
+    :return: dict with 'mean_rgbd', 'std_rgbd' (6 values, rgb then depth),
+        'class_counts' and 'class_fractions' per camera and overall
+    """
+    moments = {'rgb': runningMoments(3), 'd': runningMoments(3)}
+    cams = [camera(path) for path in loader.imgs['RGB']]
+    counts = {cam: np.zeros(loader.n_classes, dtype=np.int64) for cam in sorted(set(cams))}
+
+    frames = data.DataLoader(frameStatistics(loader), batch_size=1, num_workers=n_workers, collate_fn=_single)
+    for index, stats in enumerate(tqdm(frames)):
+        for m in ['rgb', 'd']:
+            moments[m].merge(*stats[m])
+        counts[cams[index]] += stats['hist']
+
+    total = sum(counts.values())
+    fractions = {cam: (count / max(count.sum(), 1)).tolist() for cam, count in counts.items()}
+    fractions['all'] = (total / max(total.sum(), 1)).tolist()
+    return {
+        'mean_rgbd': np.concatenate([moments['rgb'].mean, moments['d'].mean]).tolist(),
+        'std_rgbd': np.concatenate([moments['rgb'].std, moments['d'].std]).tolist(),
+        'class_counts': total.tolist(),
+        'class_fractions': fractions,
+    }
+
+
+def print_class_table(stats, class_names):
+    """Print the per-camera class fractions as one table, in percent."""
+    cams = list(stats['class_fractions'].keys())
+    print("{:<15}".format("class") + "".join("{:>10}".format(cam) for cam in cams))
+    for i, name in enumerate(class_names):
+        print("{:<15}".format(name) + "".join("{:>10.2f}".format(100 * stats['class_fractions'][cam][i])
+                                             for cam in cams))
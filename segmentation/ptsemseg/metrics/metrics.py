@@ -2,6 +2,8 @@
 # https://github.com/wkentaro/pytorch-fcn/blob/master/torchfcn/utils.py
 
 import numpy as np
+import torch
+import torch.distributed as dist
 
 
 class runningScore(object):
@@ -37,7 +39,7 @@ class runningScore(object):
             - mean IU
             - fwavacc
         """
-        hist = self.confusion_matrix
+        hist = self.host_matrix()
         overall_acc = np.diag(hist).sum() / hist.sum()
         acc_cls = np.diag(hist) / hist.sum(axis=1)
         mean_acc = np.nanmean(acc_cls)
@@ -63,10 +65,52 @@ class runningScore(object):
 
 
 
+    def host_matrix(self):
+        return self.confusion_matrix
+
     def reset(self):
         self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
 
 
+class deviceRunningScore(runningScore):
+    """runningScore with an int64 confusion matrix kept on ``device``.
+
+    update takes label and prediction tensors and scatters the whole batch
+    into the matrix without synchronising with the host: pixels with
+    invalid labels are counted in an extra overflow slot instead of being
+    masked out, so the key tensor keeps its size. Only get_scores copies
+    the n_classes x n_classes matrix back.
+    """
+    def __init__(self, n_classes, device):
+        self.device = device
+        super(deviceRunningScore, self).__init__(n_classes)
+        self.reset()
+
+    def update(self, label_trues, label_preds):
+        n = self.n_classes
+        label_preds = label_preds.to(self.device, non_blocking=True).reshape(-1).long()
+        label_trues = label_trues.to(self.device, non_blocking=True).reshape(-1).long()
+        mask = (label_trues >= 0) & (label_trues < n)
+        keys = torch.where(mask, n * label_trues + label_preds, torch.full_like(label_trues, n * n))
+        self.counts.index_add_(0, keys, torch.ones_like(keys))
+
+    def merge(self, other):
+        self.confusion_matrix += other.confusion_matrix.to(self.device)
+
+    def all_reduce(self):
+        """Sum the matrices of all processes of the default process group."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.counts)
+
+    def host_matrix(self):
+        return self.confusion_matrix.cpu().numpy().astype(np.float64)
+
+    def reset(self):
+        # the last slot collects invalid labels, confusion_matrix views the rest
+        self.counts = torch.zeros(self.n_classes ** 2 + 1, dtype=torch.int64, device=self.device)
+        self.confusion_matrix = self.counts[:-1].view(self.n_classes, self.n_classes)
+
+
 
 class averageMeter(object):
     """Computes and stores the average and current value"""
@@ -85,3 +129,62 @@ class averageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+
+class runningMoments(object):
+    """Per-channel mean and variance, mergeable across workers (Chan et al.)
+
+    Channels may have different counts, e.g. pixels grouped by class.
+    """
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+        self.reset()
+
+    def reset(self):
+        self.count = np.zeros(self.n_channels)
+        self.mean = np.zeros(self.n_channels)
+        self.m2 = np.zeros(self.n_channels)
+
+    @staticmethod
+    def moments(x):
+        """(count, mean, m2) of an array with channels on the first axis"""
+        x = np.asarray(x, dtype=np.float64).reshape(x.shape[0], -1)
+        mean = x.mean(axis=1)
+        return x.shape[1], mean, ((x - mean[:, None]) ** 2).sum(axis=1)
+
+    @staticmethod
+    def sums_to_moments(count, total, total_sq):
+        """(count, mean, m2) from per-channel count, sum and sum of squares"""
+        count = np.asarray(count, dtype=np.float64)
+        mean = np.asarray(total, dtype=np.float64) / np.maximum(count, 1)
+        m2 = np.maximum(np.asarray(total_sq, dtype=np.float64) - count * mean ** 2, 0)
+        return count, mean, m2
+
+    def update(self, x):
+        self.merge(*self.moments(x))
+
+    def merge(self, count, mean, m2):
+        count = np.broadcast_to(np.asarray(count, dtype=np.float64), self.count.shape)
+        total = self.count + count
+        safe_total = np.maximum(total, 1)
+        delta = np.asarray(mean) - self.mean
+        self.mean = np.where(total > 0, self.mean + delta * count / safe_total, self.mean)
+        self.m2 = np.where(total > 0, self.m2 + np.asarray(m2) + delta ** 2 * self.count * count / safe_total,
+                           self.m2)
+        self.count = total
+
+    def state_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        moments = cls(len(state['mean']))
+        moments.merge(state['count'], state['mean'], state['m2'])
+        return moments
+
+    @property
+    def var(self):
+        return self.m2 / np.maximum(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
@@ -14,6 +14,8 @@ def get_model(name,
               mcdo_passes=6,
               dropoutP=0.5,
               full_mcdo=False,
+              mc_micro_batch=None,
+              mc_streaming=False,
               in_channels=3,
               backbone='segnet',
               device="cpu"):
@@ -29,7 +31,9 @@ def get_model(name,
                       mcdo_passes=mcdo_passes,
                       dropoutP=dropoutP,
                       full_mcdo=full_mcdo,
-                      in_channels=in_channels,)
+                      in_channels=in_channels,
+                      mc_micro_batch=mc_micro_batch,
+                      mc_streaming=mc_streaming,)
         vgg16 = models.vgg16(pretrained=True)
         model.init_vgg16_params(vgg16)
 
@@ -39,7 +43,8 @@ def get_model(name,
     elif name == "SSMA":
         model = model(backbone=backbone, output_stride=16, n_classes=n_classes, sync_bn=True, freeze_bn=False)
     elif name == "DeepLab":
-        model = model(backbone=backbone, output_stride=16, n_classes=n_classes, sync_bn=True, freeze_bn=False)
+        model = model(backbone=backbone, output_stride=16, n_classes=n_classes, sync_bn=True, freeze_bn=False,
+                      mcdo_passes=mcdo_passes, mc_micro_batch=mc_micro_batch, mc_streaming=mc_streaming)
     else:
         model = model(n_classes=n_classes)
 
@@ -5,11 +5,17 @@ from .fusion.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
 from .fusion.aspp import build_aspp
 from .fusion.decoder import build_decoder
 from .fusion.backbone import build_backbone
-from ptsemseg.utils import mutualinfo_entropy, plotEverything, plotPrediction
+from ptsemseg.utils import mutualinfo_entropy_from_logits, plotEverything, plotPrediction
+from .mcdo import mc_forward, mcStatistics
 
 class DeepLab(nn.Module):
+    # what forward returns: the logits, (logits, entropy) or
+    # (logits, entropy, mutual_info)
+    output_modes = ('logits', 'entropy', 'uncertainty')
+
     def __init__(self, backbone='resnet', output_stride=16, n_classes=21,
-                 sync_bn=True, freeze_bn=False):
+                 sync_bn=True, freeze_bn=False, mcdo_passes=1, mc_micro_batch=None,
+                 mc_streaming=False):
         super(DeepLab, self).__init__()
         if backbone == 'drn':
             output_stride = 8
@@ -22,6 +28,14 @@ class DeepLab(nn.Module):
         self.backbone = build_backbone(backbone, output_stride, BatchNorm)
         self.aspp = build_aspp(backbone, output_stride, BatchNorm)
         self.decoder = build_decoder(n_classes, backbone, BatchNorm)
+        # rows per entropy chunk, None computes the whole frame at once
+        self.entropy_chunk = None
+        # default output mode of forward, see output_modes
+        self.output = 'entropy'
+        # more than one pass samples the decoder dropout, see mc_logits
+        self.mcdo_passes = mcdo_passes or 1
+        self.mc_micro_batch = mc_micro_batch
+        self.mc_streaming = mc_streaming
 
         if freeze_bn:
             self.freeze_bn()
@@ -34,19 +48,55 @@ class DeepLab(nn.Module):
 
     #     return x
         
-    def forward(self, input,scaling_metrics="SoftEn"):
+    def forward(self, input,scaling_metrics="SoftEn", output=None):
+        """
+        :param output: 'logits', 'entropy' or 'uncertainty' (see output_modes),
+            None uses self.output. The entropy and its full resolution
+            temporaries are only computed when asked for.
+            With mcdo_passes > 1 the logits are the mean over the MC passes.
+        """
+        output = self.output if output is None else output
+        if output not in self.output_modes:
+            raise ValueError("Unknown output mode {}, expected one of {}".format(output, self.output_modes))
+        if self.mcdo_passes > 1 and self.mc_streaming:
+            stats = self.mc_logits(input, accumulator=mcStatistics())
+            x = stats.mean()
+            if output == 'logits':
+                return x
+            entropy,mutual_info = stats.mutualinfo_entropy()
+        else:
+            if self.mcdo_passes > 1:
+                logits = self.mc_logits(input) #[batch,classes,760,1280,passes]
+                x = logits.mean(-1)
+            else:
+                x, low_level_feat = self.backbone(input)
+                x = self.aspp(x)
+                x = self.decoder(x, low_level_feat)
+                x = F.interpolate(x, size=input.size()[2:], mode='bilinear', align_corners=True)
+                logits = x.unsqueeze(-1)
+            if output == 'logits':
+                return x #[batch,classes,760,1280]
+            entropy,mutual_info = mutualinfo_entropy_from_logits(logits, self.entropy_chunk)#(batch,760,1280)
+        if output == 'entropy':
+            return x, entropy
+        return x, entropy, mutual_info
+
+
+
+    def mc_logits(self, input, out=None, accumulator=None):
+        """Logits of mcdo_passes decoder passes with dropout active, [batch,classes,H,W,passes].
+
+        The backbone, ASPP and the decoder up to its first dropout run once,
+        only the rest of the decoder head is sampled. See mc_forward for out
+        and accumulator.
+        """
         x, low_level_feat = self.backbone(input)
         x = self.aspp(x)
-        x = self.decoder(x, low_level_feat)
-        x = F.interpolate(x, size=input.size()[2:], mode='bilinear', align_corners=True)
-        x = x.unsqueeze(-1) #[batch,classes,760,1280,1]
-        mean = x.mean(-1) #[batch,classes,760,1280]
-        prob = torch.nn.Softmax(dim=1)(x) #[batch,classes,760,1280]
-        prob = prob.masked_fill(prob < 1e-9, 1e-9)
-        entropy,mutual_info = mutualinfo_entropy(prob)#(batch,760,1280)
-        return mean, entropy
-
-
+        features = self.decoder.features(x, low_level_feat)
+        head = lambda f: F.interpolate(self.decoder.head(f, MCDO=True), size=input.size()[2:],
+                                       mode='bilinear', align_corners=True)
+        return mc_forward(head, features, self.mcdo_passes, self.mc_micro_batch,
+                          out=out, accumulator=accumulator)
 
     def forward_SSMA(self, input):
         x, low_level_feat = self.backbone(input)
@@ -87,7 +137,7 @@ if __name__ == "__main__":
     model = DeepLab(backbone='mobilenet', output_stride=16)
     model.eval()
     input = torch.rand(1, 3, 512, 512)
-    output = model(input)
+    output = model(input, output='logits')
     print(output.size())
 
 
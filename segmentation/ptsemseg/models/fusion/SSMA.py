@@ -6,7 +6,7 @@ from .sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
 from ..segnet import segnet
 from ..deeplab import DeepLab
 from .decoder import build_decoder
-from ptsemseg.utils import mutualinfo_entropy, plotEverything, plotPrediction
+from ptsemseg.utils import mutualinfo_entropy_from_logits, plotEverything, plotPrediction
 from ptsemseg.models.utils import *
 import torchvision.models as models
 
@@ -64,9 +64,7 @@ class SSMA(nn.Module):
         fused_skip2 = self.SSMA_skip2(A_llf2, B_llf2)
         x = self.decoder(fused_ASPP, fused_skip1, fused_skip2)
         
-        prob = self.softmaxMCDO(x.unsqueeze(-1)) #[batch,classes,512,512]
-        prob = prob.masked_fill(prob < 1e-9, 1e-9)
-        entropy,mutual_info = mutualinfo_entropy(prob)#(batch,512,512)
+        entropy,mutual_info = mutualinfo_entropy_from_logits(x.unsqueeze(-1))#(batch,512,512)
 
 
         #temp_map_A, _ = self.tempnet_rgb(input[:, :3, :, :])
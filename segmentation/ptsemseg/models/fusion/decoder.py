@@ -37,14 +37,35 @@ class Decoder(nn.Module):
         self._init_weight()
 
 
-    def forward(self, x, low_level_feat):
+    def forward(self, x, low_level_feat, MCDO=False):
+        return self.head(self.features(x, low_level_feat), MCDO=MCDO)
+
+    def features(self, x, low_level_feat):
+        """Deterministic part, up to the first dropout of last_conv."""
         low_level_feat = self.conv1(low_level_feat)
         low_level_feat = self.bn1(low_level_feat)
         low_level_feat = self.relu(low_level_feat)
 
         x = F.interpolate(x, size=low_level_feat.size()[2:], mode='bilinear', align_corners=True)
         x = torch.cat((x, low_level_feat), dim=1)
-        x = self.last_conv(x)
+        return self.last_conv[:3](x)
+
+    def head(self, x, MCDO=False):
+        """Rest of last_conv, with dropout active in eval mode when MCDO.
+
+        The dropout modes are restored afterwards.
+        """
+        # Determine Type of Dropout
+        dropouts = [m for m in self.last_conv if isinstance(m, nn.Dropout)]
+        modes = [m.training for m in dropouts]
+        if not self.training:
+            for m in dropouts:
+                m.train(mode=MCDO)
+        try:
+            x = self.last_conv[3:](x)
+        finally:
+            for m, mode in zip(dropouts, modes):
+                m.train(mode=mode)
         # import ipdb;ipdb.set_trace()
         return x
 
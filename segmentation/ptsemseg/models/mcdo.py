@@ -0,0 +1,123 @@
+import torch
+import torch.nn.functional as F
+
+
+def mc_chunks(batch_size, passes, micro_batch=None):
+    """Split batch_size * passes stochastic forwards into calls of at most micro_batch images.
+
+    Row j * batch_size + b of the replicated batch is pass j of sample b.
+
+    :return: list of (sample index, pass index) LongTensors, one pair per call
+    """
+    total = batch_size * passes
+    micro_batch = total if micro_batch is None else max(1, int(micro_batch))
+    rows = torch.arange(total)
+    return [(chunk % batch_size, chunk // batch_size) for chunk in rows.split(micro_batch)]
+
+
+def mc_forward(forward, inputs, passes, micro_batch=None, out=None, accumulator=None):
+    """Monte Carlo passes of a stochastic forward, run as a few large batches.
+
+    The input is replicated along the batch axis so every call evaluates
+    several passes at once; each replica draws its own dropout masks.
+
+    :param forward: stochastic forward, [N,...] -> logits [N,C,H,W]
+    :param inputs: [B,...] tensor, or a tuple of tensors sharing the batch
+        axis (e.g. cached features) passed to forward as separate arguments
+    :param passes: number of MC samples per input
+    :param micro_batch: images per call, None runs all passes in one call
+    :param out: optional [B,C,H,W,passes] buffer for the logits
+    :param accumulator: object with update(logits, index, batch_size), e.g.
+        mcStatistics, receiving every call's logits and the batch index of
+        each row instead of storing them
+    :return: the [B,C,H,W,passes] logits, or accumulator when given
+    """
+    inputs = [inputs] if torch.is_tensor(inputs) else list(inputs)
+    batch_size = inputs[0].shape[0]
+    for index, pass_index in mc_chunks(batch_size, passes, micro_batch):
+        index = index.to(inputs[0].device)
+        x = forward(*[t[index] for t in inputs])
+        if accumulator is not None:
+            accumulator.update(x, index, batch_size)
+            continue
+        if out is None:
+            out = x.new_empty((batch_size,) + x.shape[1:] + (passes,))
+        out[index, :, :, :, pass_index.to(x.device)] = x
+    return accumulator if accumulator is not None else out
+
+
+class mcStatistics(object):
+    """Streaming statistics of MC passes, an accumulator for mc_forward.
+
+    Keeps per-sample sums of the logits, softmax probabilities and
+    sum_c p log p (and optionally of the logits and squared logits shifted
+    by the first pass of each sample, which keeps the variance accurate in
+    float32 when the logits are large), so memory does not grow with the
+    number of passes. With pbar the mean probability,
+    entropy = -sum_c pbar log pbar and mutual information = entropy +
+    mean_t sum_c p_t log p_t, the same values mutualinfo_entropy_from_logits
+    computes from all stored passes.
+    """
+
+    def __init__(self, variance=False):
+        self.variance = variance
+        self.count = None
+
+    def _allocate(self, logits, batch_size):
+        shape = (batch_size,) + logits.shape[1:]
+        self.sum_logits = logits.new_zeros(shape)
+        self.sum_prob = logits.new_zeros(shape)
+        self.sum_plogp = logits.new_zeros((batch_size,) + logits.shape[2:])
+        self.shift = logits.new_zeros(shape) if self.variance else None
+        self.sum_shifted = logits.new_zeros(shape) if self.variance else None
+        self.sum_sq = logits.new_zeros(shape) if self.variance else None
+        self.count = logits.new_zeros(batch_size)
+
+    def update(self, logits, index, batch_size=None):
+        """
+        :param logits: [n,C,H,W] logits of n passes
+        :param index: [n] sample of each row in the batch
+        :param batch_size: samples in the batch, by default index.max() + 1
+            of the first update
+        """
+        if self.count is None:
+            self._allocate(logits, int(index.max()) + 1 if batch_size is None else batch_size)
+        log_p = F.log_softmax(logits, dim=1)
+        p = log_p.exp()
+        self.sum_logits.index_add_(0, index, logits)
+        if self.sum_sq is not None:
+            # the first pass seen of a sample becomes its shift
+            seen = (self.count[index] > 0).view((-1,) + (1,) * (logits.dim() - 1))
+            self.shift.index_copy_(0, index, torch.where(seen, self.shift[index], logits))
+            shifted = logits - self.shift[index]
+            self.sum_shifted.index_add_(0, index, shifted)
+            self.sum_sq.index_add_(0, index, shifted * shifted)
+        self.sum_prob.index_add_(0, index, p)
+        self.sum_plogp.index_add_(0, index, (p * log_p).sum(1))
+        self.count.index_add_(0, index, torch.ones_like(index, dtype=logits.dtype))
+
+    def _passes(self, dims):
+        # pass counts broadcast over dims trailing dimensions
+        return self.count.view((-1,) + (1,) * dims)
+
+    def mean(self):
+        """Mean logits [batch,C,H,W]."""
+        return self.sum_logits / self._passes(3)
+
+    def var(self):
+        """Unbiased variance of the logits [batch,C,H,W], needs variance=True."""
+        n = self._passes(3)
+        var = (self.sum_sq - self.sum_shifted * self.sum_shifted / n) / (n - 1)
+        return var.clamp(min=0)
+
+    def mean_prob(self):
+        """Mean softmax probability [batch,C,H,W]."""
+        return self.sum_prob / self._passes(3)
+
+    def mutualinfo_entropy(self):
+        """Predictive entropy and mutual information [batch,H,W]."""
+        avg = self.mean_prob()
+        # probabilities that underflowed to 0 contribute 0
+        entropy = -(avg * avg.clamp(min=torch.finfo(avg.dtype).tiny).log()).sum(1)
+        mutual_info = entropy + self.sum_plogp / self._passes(2)
+        return entropy, mutual_info
@@ -1,17 +1,24 @@
 import torch.nn as nn
 from torch.autograd import Variable
-from ptsemseg.utils import mutualinfo_entropy
+from ptsemseg.utils import mutualinfo_entropy, mutualinfo_entropy_from_logits
 from .utils import * 
+from .mcdo import mc_forward, mcStatistics
 
 
 class segnet_mcdo(nn.Module):
+    # what forward returns, as for DeepLab: the mean logits, (logits, entropy)
+    # or (logits, entropy, mutual_info)
+    output_modes = ('logits', 'entropy', 'uncertainty')
+
     def __init__(self,
                  n_classes=21,
                  in_channels=3,
                  is_unpooling=True,
                  mcdo_passes=1,
                  dropoutP=0.1,
-                 full_mcdo=False):
+                 full_mcdo=False,
+                 mc_micro_batch=None,
+                 mc_streaming=False):
         super(segnet_mcdo, self).__init__()
 
         self.in_channels = in_channels
@@ -20,6 +27,10 @@ class segnet_mcdo(nn.Module):
         self.n_classes = n_classes
         self.dropoutP = dropoutP
         self.full_mcdo = full_mcdo
+        # images per forward call of the MC passes, None runs all passes as one batch
+        self.mc_micro_batch = mc_micro_batch
+        # reduce the MC passes to running statistics instead of storing them all
+        self.mc_streaming = mc_streaming
         if not self.full_mcdo:
             self.layers = {
                 "down1": segnetDown2(self.in_channels, 64),
@@ -102,7 +113,8 @@ class segnet_mcdo(nn.Module):
 
         l2.bias.data = l1.bias.data
 
-    def _forward(self, inputs, mcdo=True):
+    def _prefix(self, inputs, mcdo=True):
+        """down1 and down2, the blocks before the first dropout unless full_mcdo."""
 
         # if self.freeze_seg:
         #     self.eval()
@@ -114,6 +126,9 @@ class segnet_mcdo(nn.Module):
             down1, indices_1, unpool_shape1 = self.layers["down1"](inputs)
             down2, indices_2, unpool_shape2 = self.layers["down2"](down1)
 
+        return down2, indices_1, indices_2, unpool_shape1, unpool_shape2
+
+    def _suffix(self, down2, indices_1, indices_2, unpool_shape1, unpool_shape2, mcdo=True, features=False):
         down3, indices_3, unpool_shape3 = self.layers["down3"](down2, MCDO=mcdo)
         down4, indices_4, unpool_shape4 = self.layers["down4"](down3, MCDO=mcdo)
         down5, indices_5, unpool_shape5 = self.layers["down5"](down4, MCDO=mcdo)
@@ -135,75 +150,82 @@ class segnet_mcdo(nn.Module):
         # for param in self.parameters():
         #     print(param.data)
 
+        if features:
+            return up1, down4, down5
         return up1
 
+    def _forward(self, inputs, mcdo=True):
+        return self._suffix(*self._prefix(inputs, mcdo=mcdo), mcdo=mcdo)
+
+    def mc_logits(self, inputs, mcdo=True, out=None, accumulator=None):
+        """Logits of the mcdo_passes MC dropout passes, [batch,classes,H,W,passes].
+
+        Unless full_mcdo, down1 and down2 have no dropout: they run once and
+        only their output and pooling indices are replicated over the passes.
+        See mc_forward for out and accumulator.
+        """
+        if self.full_mcdo and (mcdo or self.training):
+            return mc_forward(lambda x: self._forward(x, mcdo=mcdo), inputs, self.mcdo_passes,
+                              self.mc_micro_batch, out=out, accumulator=accumulator)
+
+        down2, indices_1, indices_2, unpool_shape1, unpool_shape2 = self._prefix(inputs, mcdo=mcdo)
+        # the unpooling layers only use the spatial part of the shapes
+        suffix = lambda d, i1, i2: self._suffix(d, i1, i2, unpool_shape1, unpool_shape2, mcdo=mcdo)
+        return mc_forward(suffix, (down2, indices_1, indices_2), self.mcdo_passes,
+                          self.mc_micro_batch, out=out, accumulator=accumulator)
+
     def forwardMCDO(self, inputs, mcdo=True):
+        if self.mc_streaming:
+            with torch.no_grad():
+                stats = self.mc_logits(inputs, mcdo=mcdo, accumulator=mcStatistics(variance=True))
+            entropy, mutual_info = stats.mutualinfo_entropy()
+            return stats.mean(), stats.var(), entropy, mutual_info
+
         with torch.no_grad():
-            for i in range(self.mcdo_passes):
-                if i == 0:
-                    x = self._forward(inputs,mcdo=mcdo).unsqueeze(-1)
-                else:
-                    x = torch.cat((x, self.forward(inputs).unsqueeze(-1)), -1)
+            x = self.mc_logits(inputs, mcdo=mcdo)
 
         mean = x.mean(-1)
         variance = x.var(-1)
-
-        prob = self.softmaxMCDO(x)
-        entropy, mutual_info = mutualinfo_entropy(prob)  # (batch,512,512)
-        self.scale_logits = self._get_scale_module(scaling_module)
+        entropy, mutual_info = mutualinfo_entropy_from_logits(x)  # (batch,512,512)
 
         return mean, variance, entropy, mutual_info
 
-    def forward(self,inputs,mcdo=True):
+    def forward(self,inputs,mcdo=True,output='uncertainty'):
+        """
+        :param output: 'logits', 'entropy' or 'uncertainty' (see output_modes),
+            the entropy is only computed when asked for
+        """
+        if output not in self.output_modes:
+            raise ValueError("Unknown output mode {}, expected one of {}".format(output, self.output_modes))
         #with torch.no_grad():
-        for i in range(self.mcdo_passes):
-            if i == 0:
-                x = self._forward(inputs,mcdo=mcdo).unsqueeze(-1)
-            else:
-                x = torch.cat((x, self._forward(inputs).unsqueeze(-1)), -1)
-
-        mean = x.mean(-1)
-        prob = self.softmaxMCDO(x)
-        entropy, mutual_info = mutualinfo_entropy(prob)  # (batch,512,512)
+        if self.mc_streaming:
+            stats = self.mc_logits(inputs, mcdo=mcdo, accumulator=mcStatistics())
+            mean = stats.mean()
+            if output == 'logits':
+                return mean
+            entropy, mutual_info = stats.mutualinfo_entropy()
+        else:
+            x = self.mc_logits(inputs, mcdo=mcdo)
+
+            mean = x.mean(-1)
+            if output == 'logits':
+                return mean
+            entropy, mutual_info = mutualinfo_entropy_from_logits(x)  # (batch,512,512)
+        if output == 'entropy':
+            return mean, entropy
         return mean, entropy, mutual_info
 
 
     def forward_SSMA(self, inputs, mcdo=True):
-        # if self.freeze_seg:
-        #     self.eval()
-
-        if self.full_mcdo:
-            down1, indices_1, unpool_shape1 = self.layers["down1"](inputs, MCDO=mcdo)
-            down2, indices_2, unpool_shape2 = self.layers["down2"](down1, MCDO=mcdo)
-        else:
-            down1, indices_1, unpool_shape1 = self.layers["down1"](inputs)
-            down2, indices_2, unpool_shape2 = self.layers["down2"](down1)
-
-        down3, indices_3, unpool_shape3 = self.layers["down3"](down2, MCDO=mcdo)
-        down4, indices_4, unpool_shape4 = self.layers["down4"](down3, MCDO=mcdo)
-        down5, indices_5, unpool_shape5 = self.layers["down5"](down4, MCDO=mcdo)
+        prefix = self._prefix(inputs, mcdo=mcdo)
+        up1, down4, down5 = self._suffix(*prefix, mcdo=mcdo, features=True)
 
-        llf1 = self.llf1(down2)
+        llf1 = self.llf1(prefix[0])
         llf2 = self.llf2(down4)
 
-        up5 = self.layers["up5"](down5, indices_5, unpool_shape5, MCDO=mcdo)
-        up4 = self.layers["up4"](up5, indices_4, unpool_shape4, MCDO=mcdo)
-        up3 = self.layers["up3"](up4, indices_3, unpool_shape3, MCDO=mcdo)
-
-        if self.full_mcdo:
-            up2 = self.layers["up2"](up3, indices_2, unpool_shape2, MCDO=mcdo)
-            up1 = self.layers["up1"](up2, indices_1, unpool_shape1, MCDO=mcdo)
-        else:
-            up2 = self.layers["up2"](up3, indices_2, unpool_shape2)
-            up1 = self.layers["up1"](up2, indices_1, unpool_shape1)
-
         return up1,llf1, llf2, down5
 
     def forwardMCDO_logits(self, inputs, mcdo=True):   
         with torch.no_grad():
-            for i in range(self.mcdo_passes):
-                if i == 0:
-                    x = self._forward(inputs,mcdo=mcdo).unsqueeze(-1)
-                else:
-                    x = torch.cat((x, self.forward(inputs).unsqueeze(-1)), -1)
+            x = self.mc_logits(inputs, mcdo=mcdo)
         return x
\ No newline at end of file
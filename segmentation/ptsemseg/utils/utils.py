@@ -13,6 +13,7 @@ import copy
 import math
 import tqdm
 import os
+import csv
 import logging
 import datetime
 import numpy as np
@@ -568,52 +569,76 @@ def mem_report():
 
 
 
-def predictive_entropy(pred):
+def _chunks(n, chunk):
+    # row slices of at most ``chunk`` rows, one slice if chunk is None
+    if chunk is None or chunk >= n:
+        return [slice(0, n)]
+    return [slice(i, min(i + chunk, n)) for i in range(0, n, chunk)]
+
+
+def _mul(a, b):
+    # in place unless autograd needs the original a
+    return a * b if a.requires_grad else a.mul_(b)
+
+
+def _plogp_sum(log_p):
+    # sum_c p * log p over dim 1
+    return _mul(log_p.exp(), log_p).sum(1)
+
+
+def predictive_entropy(pred, chunk=None):
     # pred [batch,11,512,512,num_passes]
     # return [batch,512,512]
-    PEtropy = []
-    for b in range(pred.shape[0]):
-        avg = pred[b, :, :, :, :].mean(-1)  # [11,512,512]
-        entropy = avg * torch.log(avg)  # [11,512,512]
-        entropy = -entropy.sum(0)  # [512,512]
-        PEtropy.append(entropy.unsqueeze(0))
-    PEtropy = torch.cat(PEtropy)
+    # chunk: rows processed at once, bounds the temporaries
+    PEtropy = pred.new_empty((pred.shape[0],) + pred.shape[2:4])
+    for rows in _chunks(pred.shape[2], chunk):
+        avg = pred[:, :, rows].mean(-1)  # [batch,11,rows,512]
+        PEtropy[:, rows] = -_mul(avg.log(), avg).sum(1)
     return PEtropy
 
 
-def mutual_information(pred):
+def mutual_information(pred, chunk=None):
     # pred [batch,11,512,512,num_passes]
     # return [batch,512,512]
-    MI = []
-    for b in range(pred.shape[0]):
-        avg = pred[b, :, :, :, :].mean(-1)  # [11,512,512]
-        entropy = avg * torch.log(avg)  # [11,512,512]
-        entropy = -entropy.sum(0)  # [512,512]
-        expect = pred[b, :, :, :, :] * torch.log(pred[b, :, :, :, :])  # [11,512,512,10]
-        expect = expect.sum(0).mean(-1)  # (512,512)
-        MI.append((entropy + expect).unsqueeze(0))
-    MI = torch.cat(MI)
-    return MI
-
-
-def mutualinfo_entropy(pred):
+    return mutualinfo_entropy(pred, chunk)[1]
+
+
+def mutualinfo_entropy(pred, chunk=None):
     # pred [batch,11,512,512,num_passes]
     # return [batch,512,512]
-    MI = []
-    PEtropy = []
-    for b in range(pred.shape[0]):
-        avg = pred[b, :, :, :, :].mean(-1)  # [11,512,512]
-        entropy = avg * torch.log(avg)  # [11,512,512]
-        entropy = -entropy.sum(0)  # [512,512]
-        PEtropy.append(entropy.unsqueeze(0))
-        expect = pred[b, :, :, :, :] * torch.log(pred[b, :, :, :, :])  # [11,512,512,10]
-        expect = expect.sum(0).mean(-1)  # (512,512)
-        MI.append((entropy + expect).unsqueeze(0))
-    PEtropy = torch.cat(PEtropy)
-    MI = torch.cat(MI)
-    # import ipdb;ipdb.set_trace()
+    # chunk: rows processed at once, bounds the temporaries
+    PEtropy = pred.new_empty((pred.shape[0],) + pred.shape[2:4])
+    MI = pred.new_empty((pred.shape[0],) + pred.shape[2:4])
+    for rows in _chunks(pred.shape[2], chunk):
+        p = pred[:, :, rows]
+        avg = p.mean(-1)  # [batch,11,rows,512]
+        PEtropy[:, rows] = -_mul(avg.log(), avg).sum(1)
+        expect = _mul(p.log(), p).sum(1).mean(-1)  # [batch,rows,512]
+        MI[:, rows] = PEtropy[:, rows] + expect
     return PEtropy, MI
 
+
+def mutualinfo_entropy_from_logits(logits, chunk=None):
+    # logits [batch,11,512,512,num_passes], before softmax over dim 1
+    # return entropy, mutual information [batch,512,512]
+    # Works in log space with log_softmax, so probabilities never underflow
+    # to 0 and need no clamping. chunk: rows processed at once.
+    n_passes = logits.shape[-1]
+    PEtropy = logits.new_empty((logits.shape[0],) + logits.shape[2:4])
+    MI = logits.new_zeros((logits.shape[0],) + logits.shape[2:4])
+    for rows in _chunks(logits.shape[2], chunk):
+        log_p = F.log_softmax(logits[:, :, rows], dim=1)
+        if n_passes == 1:
+            # a single pass carries no mutual information
+            PEtropy[:, rows] = -_plogp_sum(log_p[..., 0])
+            continue
+        log_avg = torch.logsumexp(log_p, -1) - math.log(n_passes)  # log of the mean probability
+        PEtropy[:, rows] = -_plogp_sum(log_avg)
+        expect = _plogp_sum(log_p).mean(-1)
+        MI[:, rows] = PEtropy[:, rows] + expect
+    return PEtropy, MI
+
+
 def save_pred(logdir,loc,k,i_val,i,pred,mutual_info,entropy):
     #pred [batch,11,512,512,num_passes]
     #loc [row,col]
@@ -679,57 +704,80 @@ def plotAll(logdir, i, i_val, k, plot,miou):
 
 
 class Confidence_Diagram():
-    def __init__(self):
+    """Reliability diagram / ECE accumulator.
+
+    Pixels (or samples) are counted per (confidence bin, target class,
+    correct) with one bincount on the device of the inputs; accumulators
+    of several batches or processes add up with merge/all_reduce.
+    The class averages leave out ``ignore_classes`` (by default the two
+    reserved synthia ids) and divide by the remaining number of classes.
+    """
+    def __init__(self, n_classes=16, n_bins=10, ignore_classes=(13, 14)):
         # self.logdir = logdir
-        self.correct = np.zeros((10,19))
-        self.count = np.zeros((10,19))
-        self.confidence = np.zeros((10,19))
+        self.num_class = n_classes
+        self.n_bins = n_bins
+        self.averaged = np.array([c not in ignore_classes for c in range(n_classes)])
+        self.n_average = int(self.averaged.sum())
+        self.reset()
 
         # self.file_name = file_name
 
+    def reset(self):
+        # [count, confidence sum] x bin x class x [wrong, correct]
+        self.stats = None
+
     def aggregate_stats(self,prob,predicted,targets):
         # prob [batch,w,h]
         # predicted [batch,w,h]
         # targets [batch, w,h]
-        
-        bins = prob // 0.1 #[batch,w,h] confidence
-        bins = bins.masked_fill(bins == 10.,9)
-        # for i in range(targets.shape[1]):
-        #     mask = predicted == targets[:,i,:,:]
-
-        for i in np.linspace(0,9,10):
-            mask_bin = bins == i
-            for j in range(16):
-                mask_class = targets == j
-                self.correct[int(i),int(j)] += (predicted[mask_bin*mask_class] == targets[mask_bin*mask_class]).sum()
-                self.count[int(i),int(j)] += (mask_bin*mask_class).sum()
-                self.confidence[int(i),int(j)] +=  prob[mask_bin*mask_class].sum()
-        
+        prob = prob.reshape(-1)
+        predicted = predicted.reshape(-1).to(prob.device)
+        targets = targets.reshape(-1).to(prob.device).long()
+        if self.stats is None:
+            self.stats = torch.zeros(2 * self.n_bins * self.num_class * 2, dtype=torch.float64, device=prob.device)
+
+        mask = (targets >= 0) & (targets < self.num_class)
+        prob, predicted, targets = prob[mask], predicted[mask], targets[mask]
+        bins = (prob * self.n_bins).long().clamp(0, self.n_bins - 1) #[batch,w,h] confidence
+        keys = (bins * self.num_class + targets) * 2 + (predicted == targets).long()
+        size = self.n_bins * self.num_class * 2
+        self.stats[:size] += torch.bincount(keys, minlength=size).double()
+        self.stats[size:] += torch.bincount(keys, weights=prob.double(), minlength=size)
+
+    def merge(self, other):
+        if other.stats is not None:
+            self.stats = other.stats.clone() if self.stats is None else self.stats + other.stats.to(self.stats.device)
+
+    def all_reduce(self):
+        if self.stats is not None and torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.stats)
 
-        
-        
     def compute_ece(self):  
-        self.accuracy = self.correct/self.count
-        self.confidence = self.confidence/self.count
-        # import ipdb;ipdb.set_trace()
-        ratio = self.count/np.expand_dims(np.nansum(self.count,0),0)
+        stats = np.zeros(2 * self.n_bins * self.num_class * 2) if self.stats is None else self.stats.cpu().numpy()
+        stats = stats.reshape(2, self.n_bins, self.num_class, 2)
+        self.count = stats[0].sum(2)
+        self.correct = stats[0, :, :, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.accuracy = self.correct/self.count
+            self.confidence = stats[1].sum(2)/self.count
+            ratio = self.count/np.expand_dims(np.nansum(self.count,0),0)
         self.ece_cls = np.nansum(ratio*abs(self.accuracy - self.confidence),0)
-        self.ece = np.sum(self.ece_cls)/14
+        self.ece = np.sum(self.ece_cls[self.averaged])/self.n_average
         
     def save(self,logdir):
         with open(os.path.join(logdir,'calibration.csv'), mode='w') as calibration:
             writer = csv.writer(calibration, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
             # import ipdb;ipdb.set_trace()
-            writer.writerow(['mean accuracy per bin:']+(np.nansum(self.accuracy,1)/14).tolist())
+            writer.writerow(['mean accuracy per bin:']+(np.nansum(self.accuracy[:,self.averaged],1)/self.n_average).tolist())
             writer.writerow(['ece per class:'] + self.ece_cls.tolist())
             writer.writerow(['mean ece:',self.ece])
 
-        # logger.info('mean accuracy per bin:',np.nansum(self.accuracy,1)/14)
+        # logger.info('mean accuracy per bin:',np.nansum(self.accuracy[:,self.averaged],1)/self.n_average)
         # logger.info('ece per class:',self.ece_cls)
         # logger.info('mean ece:',self.ece)
        
     def print(self):
-        print(np.nansum(self.accuracy,1)/14)
+        print(np.nansum(self.accuracy[:,self.averaged],1)/self.n_average)
         print(self.ece_cls)
         print(self.ece)
 
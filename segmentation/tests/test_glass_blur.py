@@ -0,0 +1,40 @@
+"""Check the vectorised glass_blur against the original per-pixel loop.
+
+Run from segmentation/ with ``python -m pytest tests``.
+"""
+import numpy as np
+import pytest
+from skimage.filters import gaussian
+
+from ptsemseg.degredations.degredations import glass_blur, rgb_axis
+
+
+def glass_blur_reference(x, severity=1):
+    # the original implementation, with the 512 frame size generalised
+    c = [(0.7, 1, 2), (0.9, 2, 1), (1, 2, 3), (1.1, 3, 2), (1.5, 4, 2)][severity - 1]
+
+    x = np.uint8(gaussian(np.array(x) / 255., sigma=c[0], **rgb_axis) * 255)
+    height, width = x.shape[:2]
+
+    # locally shuffle pixels
+    for i in range(c[2]):
+        for h in range(height - c[1], c[1], -1):
+            for w in range(width - c[1], c[1], -1):
+                dx, dy = np.random.randint(-c[1], c[1], size=(2,))
+                h_prime, w_prime = h + dy, w + dx
+                # swap
+                x[h, w], x[h_prime, w_prime] = x[h_prime, w_prime], x[h, w]
+
+    return np.clip(gaussian(x / 255., sigma=c[0], **rgb_axis), 0, 1) * 255
+
+
+@pytest.mark.parametrize("severity", [1, 2, 3, 4, 5])
+def test_glass_blur_matches_reference(severity):
+    frame = np.random.RandomState(severity).randint(0, 256, size=(64, 64, 3)).astype(np.uint8)
+
+    np.random.seed(severity)
+    expected = glass_blur_reference(frame, severity)
+    np.random.seed(severity)
+    actual = glass_blur(frame, severity)
+
+    np.testing.assert_array_equal(actual, expected)
@@ -0,0 +1,84 @@
+"""Check the OpenCV motion blur against ImageMagick's MagickMotionBlurImage.
+
+Run from segmentation/ with ``python -m pytest tests``. The comparison with
+ImageMagick itself needs Wand and the MagickWand library and is skipped
+without them; the port of ImageMagick's algorithm below runs everywhere.
+"""
+import math
+from io import BytesIO
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from ptsemseg.degredations.degredations import _motion_blur
+
+# (radius, sigma, angle): the motion_blur and snow severities at a few angles
+cases = [(10, 3, 0.), (15, 5, 30.), (15, 8, -45.), (15, 12, 12.5),
+         (20, 15, -27.), (12, 4, -100.), (12, 8, -135.)]
+
+
+def frame(shape=(64, 80, 3)):
+    # smooth content keeps the uint8 rounding of ImageMagick small
+    x = np.random.RandomState(0).randint(0, 256, size=shape).astype(np.float32)
+    return np.uint8(cv2.GaussianBlur(x, (0, 0), 2))
+
+
+def imagemagick_port(x, radius, sigma, angle):
+    """Shift-and-sum port of MotionBlurImage in ImageMagick's effect.c."""
+    width = 2 * int(math.ceil(radius)) + 1
+    kernel = np.exp(-np.arange(width) ** 2 / (2.0 * sigma ** 2)) / (math.sqrt(2 * math.pi) * sigma)
+    kernel /= kernel.sum()
+    point_x = width * math.sin(math.radians(angle))
+    point_y = width * math.cos(math.radians(angle))
+    hypot = math.hypot(point_x, point_y)
+
+    x = np.asarray(x, dtype=np.float64)
+    h, w = x.shape[:2]
+    # edge virtual pixels
+    padded = np.pad(x, [(width, width), (width, width)] + [(0, 0)] * (x.ndim - 2), mode='edge')
+    out = np.zeros_like(x)
+    for i in range(width):
+        dx = int(math.ceil(i * point_y / hypot - 0.5))
+        dy = int(math.ceil(i * point_x / hypot - 0.5))
+        out += kernel[i] * padded[width + dy:width + dy + h, width + dx:width + dx + w]
+    return out
+
+
+def imagemagick(x, radius, sigma, angle):
+    """The Wand round trip motion_blur used before the OpenCV version."""
+    import ctypes
+    from wand.api import library as wandlibrary
+    from wand.image import Image as WandImage
+
+    wandlibrary.MagickMotionBlurImage.argtypes = (ctypes.c_void_p, ctypes.c_double,
+                                                  ctypes.c_double, ctypes.c_double)
+    output = BytesIO()
+    Image.fromarray(x).save(output, format='PNG')
+    with WandImage(blob=output.getvalue()) as img:
+        wandlibrary.MagickMotionBlurImage(img.wand, radius, sigma, angle)
+        blob = img.make_blob()
+    x = cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_UNCHANGED)
+    return x[..., [2, 1, 0]] if x.ndim == 3 else x
+
+
+@pytest.mark.parametrize("radius,sigma,angle", cases)
+def test_motion_blur_matches_imagemagick_port(radius, sigma, angle):
+    x = frame()
+    np.testing.assert_allclose(_motion_blur(x, radius, sigma, angle),
+                               imagemagick_port(x, radius, sigma, angle), atol=1e-3)
+
+
+@pytest.mark.parametrize("radius,sigma,angle", cases)
+def test_motion_blur_matches_imagemagick(radius, sigma, angle):
+    try:
+        import wand.image
+    except ImportError:
+        # Wand raises ImportError when the MagickWand library is missing too
+        pytest.skip("needs Wand and ImageMagick")
+    x = frame()
+    expected = imagemagick(x, radius, sigma, angle).astype(np.float32)
+    actual = np.round(_motion_blur(x, radius, sigma, angle))
+    # ImageMagick works on 8 bit quanta
+    assert np.abs(actual - expected).max() <= 1
@@ -10,11 +10,11 @@ from torch.utils import data
 from tqdm import tqdm
 from ptsemseg.models import get_model
 from ptsemseg.loss import get_loss_function
-from ptsemseg.loader import get_loaders
+from ptsemseg.loader import get_loaders, deviceTransform
 from ptsemseg.utils import get_logger, parseEightCameras, plotPrediction, plotEverything, mutualinfo_entropy
-from ptsemseg.metrics import runningScore, averageMeter
+from ptsemseg.metrics import deviceRunningScore, averageMeter
 from ptsemseg.degredations import *
-from ptsemseg.core import likelihood_flattening, prior_recbalancing, fusion
+from ptsemseg.core import unoFusion, modalityExecutor
 from tensorboardX import SummaryWriter
 from collections import defaultdict
 
@@ -44,7 +44,7 @@ def validate(cfg, writer, logger, logdir):
     # Setup Dataloader
     loaders, n_classes = get_loaders(cfg["data"]["dataset"], cfg)
     # Setup Metrics
-    running_metrics_val = {env: runningScore(n_classes) for env in loaders['val'].keys()}
+    running_metrics_val = {env: deviceRunningScore(n_classes, device) for env in loaders['val'].keys()}
     models = {}
     # Setup Model
     for model, attr in cfg["models"].items():
@@ -56,6 +56,8 @@ def validate(cfg, writer, logger, logdir):
                                   mcdo_passes=attr['mcdo_passes'],
                                   dropoutP=attr['dropoutP'],
                                   full_mcdo=attr['full_mcdo'],
+                                  mc_micro_batch=attr['mc_micro_batch'],
+                                  mc_streaming=bool(attr['mc_streaming']),
                                   backbone=attr['backbone'],
                                   device=device).to(device)
         models[model] = torch.nn.DataParallel(models[model], device_ids=range(torch.cuda.device_count()))
@@ -85,6 +87,13 @@ def validate(cfg, writer, logger, logdir):
     prior = torch.load(os.path.join(stats_dir,'stats','prior.pkl'))
     prior = torch.tensor(prior).unsqueeze(0).unsqueeze(2).unsqueeze(3).to(device).float() # (1, n_class, 1, 1)
     entropy_stats = torch.load(os.path.join(stats_dir,'stats','entropy.pkl'))
+    # uncertainty scaling, imbalance calibration and fusion, prior terms computed once
+    uno = unoFusion(cfg, prior=prior, entropy_stats=entropy_stats)
+    fused = None
+    # runs the modality experts concurrently (CUDA streams or threads) and times them
+    executor = modalityExecutor(cfg["models"].keys(), device,
+                                concurrent=bool(cfg.get('concurrent_modalities')),
+                                pin=bool(cfg.get('pin_modality_cores')))
     [models[m].eval() for m in models.keys()]
     #################################################################################
     # Validation
@@ -93,43 +102,66 @@ def validate(cfg, writer, logger, logdir):
 
     with torch.no_grad():
         for k, valloader in loaders['val'].items():
+            if cfg['data'].get('uint8'):
+                transform = deviceTransform.from_loader(valloader.dataset, device)
+            # display tensors are only needed for the plotted frames
+            valloader.dataset.display = False
             for i_val, (input_list, labels_list) in tqdm(enumerate(valloader)):
-                inputs_display, _ = parseEightCameras(input_list['rgb_display'], labels_list, input_list['d_display'], device)
+                plot = i_val % cfg["training"]["png_frames"] == 0
+                if cfg['data'].get('uint8'):
+                    input_list, labels_list = transform(input_list, labels_list, display=plot)
+                elif plot:
+                    display = valloader.dataset.get_display(input_list)
+                    input_list['rgb_display'] = [display['rgb_display']]
+                    input_list['d_display'] = [display['d_display']]
+                if plot:
+                    inputs_display, _ = parseEightCameras(input_list['rgb_display'], labels_list, input_list['d_display'], device)
                 images_val = {m: input_list[m][0] for m in cfg["models"].keys()}
                 labels_val = labels_list[0]
                 if labels_val.shape[0] <= 1:
                     continue
-                mean = {}
-                entropy = {}
-                val_loss = {}
-                # Inference
-                for m in cfg["models"].keys():
-                    mean[m], entropy[m] = models[m](images_val[m])
-                    mean[m] = likelihood_flattening(mean[m], cfg, entropy[m], entropy_stats, modality = m)
-                mean = prior_recbalancing(mean,cfg,prior=prior)
-                outputs = fusion(mean,cfg)
-        
+                # Inference, the entropy is only needed for uncertainty scaling and plots
+                output = 'entropy' if cfg['uncertainty'] or plot else 'logits'
+
+                def infer(m):
+                    if output == 'logits':
+                        return models[m](images_val[m], output=output), None
+                    return models[m](images_val[m], output=output)
+
+                results = executor(infer)
+                mean = {m: results[m][0] for m in cfg["models"].keys()}
+                entropy = {m: results[m][1] for m in cfg["models"].keys()}
+                first = mean[executor.modalities[0]]
+                if fused is None or fused.shape != first.shape:
+                    fused = torch.empty_like(first)
+                outputs = uno(mean, entropy, out=fused)
+
                 prob, pred = outputs.max(1)
                 gt = labels_val
-                outputs = outputs.masked_fill(outputs < 1e-9, 1e-9)
-                e, _ = mutualinfo_entropy(outputs.unsqueeze(-1))
-                if i_val % cfg["training"]["png_frames"] == 0:
+                if plot:
+                    e, _ = mutualinfo_entropy(outputs.clamp(min=1e-9).unsqueeze(-1))
                     plotPrediction(logdir, cfg, n_classes, 0, i_val,  k + "/fused", inputs_display, pred, gt)
                     labels = ['entropy', 'probability']
                     values = [e, prob]
                     plotEverything(logdir, 0, i_val, k + "/fused", values, labels)
 
                     for m in cfg["models"].keys():
-                        prob,pred_m = torch.nn.Softmax(dim=1)(mean[m]).max(1)
+                        prob,pred_m = torch.nn.Softmax(dim=1)(uno.calibrated(mean[m], entropy[m], m)).max(1)
                         labels = [ 'entropy', 'probability']
                         values = [ entropy[m], prob]
                         plotPrediction(logdir, cfg, n_classes, 0, i_val, k + "/" + m, inputs_display, pred_m, gt)
                         plotEverything(logdir, 0, i_val, k + "/" + m, values, labels)
                     
-                running_metrics_val[k].update(gt.data.cpu().numpy(), pred.cpu().numpy())
+                running_metrics_val[k].update(gt, pred)
           
 
+    executor.close()
+    for m, latency in executor.latency().items():
+        logger.info('latency_{}: {:.2f} ms'.format(m, latency))
+        writer.add_scalar('val_latency/{}'.format(m), latency, 1)
+
     for env, valloader in loaders['val'].items():
+        running_metrics_val[env].all_reduce()
         score, class_iou, class_acc,count = running_metrics_val[env].get_scores()
         for k, v in score.items():
             logger.info('{}: {}'.format(k, v))